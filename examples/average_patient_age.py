@@ -1,7 +1,7 @@
 from fhir_parser import FHIR
 
 fhir = FHIR()
-patients = fhir.get_all_patients()
+patients = fhir.iter_patients()
 
 ages = []
 for patient in patients:
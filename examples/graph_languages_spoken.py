@@ -1,13 +1,11 @@
 import matplotlib.pyplot as plt
 from fhir_parser import FHIR
+from fhir_parser.frame import PatientFrame
 
 fhir = FHIR()
-patients = fhir.get_all_patients()
+patients = PatientFrame.from_patients(fhir.iter_patients())
 
-languages = {}
-for patient in patients:
-    for language in patient.communications.languages:
-        languages.update({language: languages.get(language, 0) + 1})
+languages = patients.histogram('languages')
 
 
 plt.bar(range(len(languages)), list(languages.values()), align='center')
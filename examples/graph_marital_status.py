@@ -1,15 +1,12 @@
 import matplotlib.pyplot as plt
 from fhir_parser import FHIR
+from fhir_parser.frame import PatientFrame
+from fhir_parser.patient import MaritalStatus
 
 fhir = FHIR()
-patients = fhir.get_all_patients()
+patients = PatientFrame.from_patients(fhir.iter_patients())
 
-marital_status = {}
-for patient in patients:
-    if str(patient.marital_status) in marital_status:
-        marital_status[str(patient.marital_status)] += 1
-    else:
-        marital_status[str(patient.marital_status)] = 1
+marital_status = {str(MaritalStatus(code)): count for code, count in patients.histogram('marital_status').items()}
 
 
 plt.bar(range(len(marital_status)), list(marital_status.values()), align='center')
@@ -1,24 +1,23 @@
 from fhir_parser import FHIR
+from fhir_parser.frame import ObservationFrame
 
-fhir = FHIR()
+fhir = FHIR(pool_size=8)
 patients = fhir.get_all_patients()
 observations = []
 
-for patient in patients:
-    observations.extend(fhir.get_patient_observations(patient.uuid))
+for patient_observations in fhir.get_patients_observations(patient.uuid for patient in patients).values():
+    observations.extend(patient_observations)
 
 print("Total of {} observations".format(len(observations)))
 
-observation_types = [observation.type for observation in observations]
-most_frequent_observation_type = max(set(observation_types), key=observation_types.count)
-print("Most common observation type: {}".format(most_frequent_observation_type))
-
-observation_components = []
+observation_types = {}
 for observation in observations:
-    observation_components.extend(observation.components)
+    observation_types[observation.type] = observation_types.get(observation.type, 0) + 1
+most_frequent_observation_type = max(observation_types, key=observation_types.get)
+print("Most common observation type: {}".format(most_frequent_observation_type))
 
-print("Total of {} observation components".format(len(observation_components)))
+frame = ObservationFrame.from_observations(observations)
+print("Total of {} observation components".format(len(frame)))
 
-observation_component_types = [observation_component.display for observation_component in observation_components]
-most_frequent_observation_component_type = max(set(observation_types), key=observation_types.count)
+most_frequent_observation_component_type = next(iter(frame.value_counts('display')))
 print("Most common observation component type: {}".format(most_frequent_observation_component_type))
\ No newline at end of file
@@ -1,5 +1,6 @@
+from .async_fhir import AsyncFHIR
 from .fhir import FHIR
 from .observation import Observation
 from .patient import Patient
 
-__all__ = ['FHIR', 'Patient', 'Observation']
\ No newline at end of file
+__all__ = ['FHIR', 'AsyncFHIR', 'Patient', 'Observation']
\ No newline at end of file
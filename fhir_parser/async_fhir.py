@@ -0,0 +1,248 @@
+"""
+AsyncFHIR
+=========
+An asyncio version of the FHIR class for keeping many FHIR endpoint calls in flight at once, requires aiohttp
+"""
+
+import asyncio
+import urllib.parse
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+from fhir_parser.fhir import projected, search_path
+from fhir_parser.observation import Observation
+from fhir_parser.parser import str_to_patient, str_to_error, str_to_patients, str_to_observation, str_to_observations, \
+    iter_bundle_patients, iter_bundle_observations, has_next_page, page_bundles, loads
+from fhir_parser.patient import Patient
+from fhir_parser.transport import RETRY_STATUSES, RateLimiter, StatusError, backoff_delay, retry_after
+
+
+class AsyncFHIR:
+    """Create the asynchronous FHIR endpoint to retrieve patient and observation data, at most max_concurrency
+    requests are in flight at once. See FHIR for lazy, timeout, retries, backoff and rate_limit, waiting between
+    retries and for the rate limit is done with asyncio.sleep so the event loop is never blocked. Results of an
+    _elements search are always parsed lazily."""
+
+    def __init__(self, endpoint: str = 'https://localhost:5001/api/', verify_ssl: bool = False,
+                 ignore_errors: bool = True, max_concurrency: int = 20, lazy: bool = False,
+                 timeout: Optional[Tuple[float, float]] = (10.0, 60.0), retries: int = 3, backoff: float = 0.5,
+                 max_backoff: float = 30.0, rate_limit: Optional[float] = None):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError('AsyncFHIR requires aiohttp, install it with pip install aiohttp')
+        self.endpoint = endpoint
+        self.verify_ssl = verify_ssl
+        self.ignore_errors = ignore_errors
+        self.lazy = lazy
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter: Optional[RateLimiter] = RateLimiter(rate_limit) if rate_limit else None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._session = None
+
+    async def __aenter__(self) -> 'AsyncFHIR':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Closes the underlying session and any pooled connections"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _get(self, path: str) -> bytes:
+        import aiohttp
+        # The session and semaphore are bound to the running event loop so are only created on first use
+        if self._session is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, ssl=None if self.verify_ssl else False),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+                if self.timeout is not None else aiohttp.ClientTimeout())
+        url = urllib.parse.urljoin(self.endpoint, path)
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            try:
+                async with self._semaphore:
+                    async with self._session.get(url) as response:
+                        content = await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+                continue
+            if response.status not in RETRY_STATUSES or attempt == self.retries:
+                break
+            delay = retry_after(response) if response.status in (429, 503) else None
+            if delay is None:
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+            elif self.rate_limiter is not None:
+                # The server is throttling the client as a whole, so every request holds back
+                self.rate_limiter.pause(delay)
+                continue
+            await asyncio.sleep(delay)
+        self._error_response(response.status, content)
+        return content
+
+    def _error_response(self, status: int, content: bytes):
+        if content == b'' or status != 200:
+            raise StatusError(status)
+        if b'OperationOutcome' in content and str_to_error(content) is not None:
+            raise ConnectionError(str_to_error(content))
+
+    async def _iter_pages(self, path: str, parser: Callable, corrupt: str,
+                          search: Optional[Dict[str, Any]] = None) -> AsyncIterator:
+        page = 1
+        while True:
+            bundles = page_bundles(loads(await self._get(path.format(page))), page)
+            try:
+                parsed = list(parser(bundles, ignore_errors=self.ignore_errors, lazy=self.lazy or projected(search)))
+            except KeyError:
+                raise AttributeError(corrupt)
+            for item in parsed:
+                yield item
+            if len(bundles) == 0 or not has_next_page(bundles[-1]):
+                return
+            page += 1
+
+    async def get_all_patients(self, search: Optional[Dict[str, Any]] = None) -> List[Patient]:
+        """
+        Args:
+            search: Search parameters such as _count or _elements, see search_path
+
+        Returns: A list of patients
+
+        """
+        content = await self._get(search_path('Patient/', search))
+        try:
+            return str_to_patients(content, ignore_errors=self.ignore_errors,
+                                   lazy=self.lazy or projected(search))
+        except KeyError:
+            raise AttributeError('Patient data is corrupt')
+
+    async def get_patient_page(self, page: int, search: Optional[Dict[str, Any]] = None) -> List[Patient]:
+        """
+        Args:
+            page: Page number int
+            search: Search parameters such as _count or _elements, see search_path
+
+        Returns: A list of patients up to the specified page
+
+        """
+        content = await self._get(search_path('Patient/pages/' + str(page), search))
+        try:
+            return str_to_patients(content, ignore_errors=self.ignore_errors,
+                                   lazy=self.lazy or projected(search))
+        except KeyError:
+            raise AttributeError('Patient data is corrupt')
+
+    def iter_patients(self, search: Optional[Dict[str, Any]] = None) -> AsyncIterator[Patient]:
+        """ Lazily walks the patient pages, only requesting the next page once the current one is consumed
+        Args:
+            search: Search parameters such as _count or _elements, see search_path
+
+        Returns: An asynchronous iterator of patients
+
+        """
+        return self._iter_pages(search_path('Patient/pages/{}', search), iter_bundle_patients,
+                                'Patient data is corrupt', search)
+
+    async def get_patient(self, id: str) -> Patient:
+        """
+        Args:
+            id: Patient ID or UUID string
+
+        Returns: A single patient
+
+        """
+        content = await self._get('Patient/' + str(id))
+        try:
+            return str_to_patient(content, lazy=self.lazy)
+        except KeyError:
+            raise AttributeError('Patient data is corrupt')
+
+    async def get_observation(self, id: str) -> Observation:
+        """
+        Args:
+            id: Observation ID or UUID string
+
+        Returns: A single observation
+
+        """
+        content = await self._get('Observation/single/' + str(id))
+        try:
+            return str_to_observation(content, lazy=self.lazy)
+        except KeyError:
+            raise AttributeError('Observation data is corrupt')
+
+    async def get_patient_observations(self, id: str, search: Optional[Dict[str, Any]] = None) -> List[Observation]:
+        """
+        Args:
+            id: Patient ID or UUID string
+            search: Search parameters such as code, date, category, _count or _elements, see search_path
+
+        Returns: A list of observations for a patient
+
+        """
+        content = await self._get(search_path('Observation/' + str(id), search))
+        try:
+            return str_to_observations(content, ignore_errors=self.ignore_errors,
+                                       lazy=self.lazy or projected(search))
+        except KeyError:
+            raise AttributeError('Observation data from patient is corrupt')
+
+    def iter_patient_observations(self, id: str, search: Optional[Dict[str, Any]] = None) -> AsyncIterator[Observation]:
+        """ Lazily walks the observation pages for a patient, only requesting the next page once the current one is
+        consumed
+        Args:
+            id: Patient ID or UUID string
+            search: Search parameters such as code, date, category, _count or _elements, see search_path
+
+        Returns: An asynchronous iterator of observations for a patient
+
+        """
+        return self._iter_pages(search_path('Observation/pages/{}/' + str(id), search), iter_bundle_observations,
+                                'Observation data from patient is corrupt', search)
+
+    async def get_patient_observations_page(self, id: str, page: int,
+                                            search: Optional[Dict[str, Any]] = None) -> List[Observation]:
+        """
+        Args:
+            id: Patient ID or UUID string
+            page: Page number int
+            search: Search parameters such as code, date, category, _count or _elements, see search_path
+
+        Returns: A list of observations for a patient up to the specified page
+
+        """
+        content = await self._get(search_path('Observation/pages/' + str(page) + '/' + str(id), search))
+        try:
+            return str_to_observations(content, ignore_errors=self.ignore_errors,
+                                       lazy=self.lazy or projected(search))
+        except KeyError:
+            raise AttributeError('Observation data from patient is corrupt')
+
+    async def gather_patient_observations(self, ids: Iterable[str],
+                                          search: Optional[Dict[str, Any]] = None) -> Dict[str, List[Observation]]:
+        """ Fetches the observations for many patients concurrently, bounded by max_concurrency. With ignore_errors a
+        patient that fails is left out, otherwise the first error is raised once every request has finished.
+        Args:
+            ids: Patient IDs or UUID strings
+            search: Search parameters for every patient, see get_patient_observations
+
+        Returns: A dictionary of patient ID to the list of observations for that patient, in the order of ids
+
+        """
+        ids = list(dict.fromkeys(map(str, ids)))
+        results = await asyncio.gather(*[self.get_patient_observations(id, search) for id in ids],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not self.ignore_errors:
+                raise result
+        return {id: result for id, result in zip(ids, results) if not isinstance(result, Exception)}
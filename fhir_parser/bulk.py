@@ -0,0 +1,209 @@
+"""
+Bulk
+====
+Parses directories of pre-downloaded bundle files on a process pool. Files are JSON (a bundle list as returned by the
+FHIR endpoint, a single bundle or a single resource) or NDJSON with a resource or bundle per line, optionally gzip
+compressed. Run ``python -m fhir_parser.bulk`` for the command line interface.
+"""
+
+import argparse
+import glob
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterable, Iterator, List, Optional, Tuple, Union
+
+from fhir_parser.observation import Observation
+from fhir_parser.parser import dict_to_patient, dict_to_observation, loads
+from fhir_parser.patient import Patient
+
+EXTENSIONS: List[str] = ['.json', '.ndjson', '.jsonl']
+NDJSON_EXTENSIONS: List[str] = ['.ndjson', '.jsonl']
+CHUNK_SIZE: int = 16 * 2 ** 20
+
+# A shard is a file path and the byte range of it to parse, the whole file when the range is None
+Shard = Tuple[str, Optional[Tuple[int, int]]]
+
+
+def _extension(path: str) -> str:
+    root, extension = os.path.splitext(path[:-3] if path.endswith('.gz') else path)
+    return extension.lower()
+
+
+def find_files(paths: Union[str, Iterable[str]]) -> List[str]:
+    """
+    Args:
+        paths: Directories, glob patterns or file paths
+
+    Returns: The bundle files, every JSON or NDJSON file (optionally .gz) directly in a directory in name order
+
+    """
+    files: List[str] = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if _extension(name) in EXTENSIONS and os.path.isfile(os.path.join(path, name))))
+        else:
+            files.extend(sorted(glob.glob(path)))
+    return files
+
+
+def _shards(files: List[str], chunk_size: int) -> List[Shard]:
+    # Uncompressed NDJSON files are split into byte ranges so a single large file is spread across the pool
+    shards: List[Shard] = []
+    for path in files:
+        if _extension(path) in NDJSON_EXTENSIONS and not path.endswith('.gz'):
+            size = os.path.getsize(path)
+            shards.extend((path, (start, min(start + chunk_size, size))) for start in range(0, size, chunk_size))
+        else:
+            shards.append((path, None))
+    return shards
+
+
+def _lines(path: str, byte_range: Optional[Tuple[int, int]]) -> Iterator[bytes]:
+    if byte_range is None:
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as file:
+            yield from file
+        return
+    start, end = byte_range
+    with open(path, 'rb') as file:
+        # A line belongs to the range it starts in, so skip the rest of a line started in the previous range
+        if start > 0:
+            file.seek(start - 1)
+            file.readline()
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                return
+            yield line
+
+
+def _resources(input: Any, ignore_errors: bool) -> Iterator[dict]:
+    if isinstance(input, list):
+        for item in input:
+            yield from _resources(item, ignore_errors)
+    elif isinstance(input, dict) and input.get('resourceType') == 'Bundle':
+        for entry in input.get('entry', []):
+            try:
+                resource = entry['resource']
+            except (KeyError, TypeError) as e:
+                if ignore_errors:
+                    continue
+                raise e
+            yield resource
+    else:
+        yield input
+
+
+def _decode(content: bytes, ignore_errors: bool) -> Iterator[dict]:
+    # A line or file that is not valid JSON is skipped whole, the rest of the shard is still parsed
+    try:
+        decoded = loads(content)
+    except Exception as e:
+        if ignore_errors:
+            return
+        raise e
+    yield from _resources(decoded, ignore_errors)
+
+
+def _shard_resources(shard: Shard, ignore_errors: bool) -> Iterator[dict]:
+    path, byte_range = shard
+    if _extension(path) in NDJSON_EXTENSIONS:
+        for line in _lines(path, byte_range):
+            if line.strip():
+                yield from _decode(line, ignore_errors)
+    else:
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as file:
+            yield from _decode(file.read(), ignore_errors)
+
+
+def _parse_shard(shard: Shard, ignore_errors: bool, frames: bool) -> Tuple[Any, Any]:
+    patients: List[Patient] = []
+    observations: List[Observation] = []
+    for resource in _shard_resources(shard, ignore_errors):
+        try:
+            if resource.get('resourceType') == 'Patient':
+                patients.append(dict_to_patient(resource, lazy=frames, check=ignore_errors))
+            elif resource.get('resourceType') == 'Observation':
+                observations.append(dict_to_observation(resource, lazy=frames, check=ignore_errors))
+        except Exception as e:
+            if ignore_errors:
+                continue
+            raise e
+    if frames:
+        # Frames are built in the worker so only the arrays are sent back, not every object
+        from fhir_parser.frame import ObservationFrame, PatientFrame, decoded
+        return PatientFrame.from_patients(decoded(patients, PatientFrame.FIELDS, ignore_errors)), \
+            ObservationFrame.from_observations(decoded(observations, ObservationFrame.FIELDS, ignore_errors))
+    return patients, observations
+
+
+def _parse(paths: Union[str, Iterable[str]], processes: Optional[int], ignore_errors: bool, frames: bool,
+           chunk_size: int) -> Iterator[Tuple[Any, Any]]:
+    shards = _shards(find_files(paths), chunk_size)
+    if processes == 1 or len(shards) <= 1:
+        for shard in shards:
+            yield _parse_shard(shard, ignore_errors, frames)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        yield from executor.map(_parse_shard, shards, [ignore_errors] * len(shards), [frames] * len(shards))
+
+
+def parse_files(paths: Union[str, Iterable[str]], processes: Optional[int] = None, ignore_errors: bool = False,
+                chunk_size: int = CHUNK_SIZE) -> Tuple[List[Patient], List[Observation]]:
+    """ Parses bundle files on a process pool, each file (or chunk_size bytes of an uncompressed NDJSON file) is
+    parsed by one worker. Resources other than patients and observations are skipped.
+    Args:
+        paths: Directories, glob patterns or file paths, see find_files
+        processes: Number of worker processes, the number of CPUs if None, 1 parses in this process
+        ignore_errors: Skip resources, NDJSON lines and files that fail to parse
+        chunk_size: Number of bytes of NDJSON each worker parses at a time
+
+    Returns: The patients and observations in file order
+
+    """
+    patients: List[Patient] = []
+    observations: List[Observation] = []
+    for shard_patients, shard_observations in _parse(paths, processes, ignore_errors, False, chunk_size):
+        patients.extend(shard_patients)
+        observations.extend(shard_observations)
+    return patients, observations
+
+
+def parse_files_to_frames(paths: Union[str, Iterable[str]], processes: Optional[int] = None,
+                          ignore_errors: bool = False, chunk_size: int = CHUNK_SIZE):
+    """ Parses bundle files on a process pool straight into frames, each worker builds the frames for its files and
+    only the arrays are sent back, requires numpy. See parse_files.
+    Args:
+        paths: Directories, glob patterns or file paths, see find_files
+        processes: Number of worker processes, the number of CPUs if None, 1 parses in this process
+        ignore_errors: Skip resources, NDJSON lines and files that fail to parse
+        chunk_size: Number of bytes of NDJSON each worker parses at a time
+
+    Returns: The PatientFrame and ObservationFrame in file order
+
+    """
+    from fhir_parser.frame import ObservationFrame, PatientFrame
+    shards = list(_parse(paths, processes, ignore_errors, True, chunk_size))
+    return PatientFrame.concat([s[0] for s in shards]), ObservationFrame.concat([s[1] for s in shards])
+
+
+def main(args: Optional[List[str]] = None):
+    """Command line entry point, parses bundle files and prints the number of patients and observations, optionally
+    writing them to a snapshot"""
+    arguments = argparse.ArgumentParser(description='Parse pre-downloaded FHIR bundle files on a process pool')
+    arguments.add_argument('paths', nargs='+', help='Directories, glob patterns or bundle files')
+    arguments.add_argument('--processes', type=int, default=None, help='Number of worker processes')
+    arguments.add_argument('--ignore-errors', action='store_true', help='Skip resources that fail to parse')
+    arguments.add_argument('--snapshot', default=None, help='Directory to write a snapshot to, requires pyarrow')
+    options = arguments.parse_args(args)
+
+    patients, observations = parse_files(options.paths, options.processes, options.ignore_errors)
+    print('{} patients, {} observations'.format(len(patients), len(observations)))
+    if options.snapshot is not None:
+        from fhir_parser.snapshot import write_snapshot
+        write_snapshot(options.snapshot, patients, observations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Cache
+=====
+Response caches for the FHIR class, keyed by endpoint path, either held in memory or persisted to disk
+"""
+
+import abc
+import collections
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Optional, OrderedDict, Tuple
+
+
+class Cache(abc.ABC):
+    """The base cache, counting hits and misses, entries older than ttl seconds are treated as missing. A parsed
+    cache stores parsed Patient and Observation objects, otherwise the raw response bodies are stored. Entries stored
+    with validators (the If-None-Match and If-Modified-Since request headers) are kept once expired so they can be
+    revalidated with the server instead of downloaded again"""
+    def __init__(self, ttl: Optional[float] = None, parsed: bool = False):
+        self.ttl: Optional[float] = ttl
+        self.parsed: bool = parsed
+        self.hits: int = 0
+        self.misses: int = 0
+        self.revalidations: int = 0
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def _load(self, key: str) -> Optional[Tuple[Any, float, Optional[Dict[str, str]]]]:
+        pass
+
+    @abc.abstractmethod
+    def _store(self, key: str, value: Any, stored: float, validators: Optional[Dict[str, str]]):
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, key: str):
+        pass
+
+    def get(self, key: str) -> Optional[Any]:
+        """ Gets a cached value, counting a hit or a miss
+        Args:
+            key: Endpoint path
+
+        Returns: The cached value or None if not cached or expired
+
+        """
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                if entry[2] is None:
+                    self._delete(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value: Any, validators: Optional[Dict[str, str]] = None):
+        """ Caches a value
+        Args:
+            key: Endpoint path
+            value: Raw response body or parsed object
+            validators: Request headers to revalidate the value with once expired
+
+        """
+        with self._lock:
+            self._store(key, value, time.time(), validators)
+
+    def stale(self, key: str) -> Optional[Tuple[Any, Dict[str, str]]]:
+        """ Gets a value that can be revalidated with the server, regardless of its age
+        Args:
+            key: Endpoint path
+
+        Returns: The cached value and its validators or None if there is nothing to revalidate
+
+        """
+        with self._lock:
+            entry = self._load(key)
+            if entry is None or entry[2] is None:
+                return None
+            return entry[0], entry[2]
+
+    def revalidate(self, key: str):
+        """ Marks a value as fresh again after the server confirmed it has not been modified
+        Args:
+            key: Endpoint path
+
+        """
+        with self._lock:
+            entry = self._load(key)
+            if entry is not None:
+                self._store(key, entry[0], time.time(), entry[2])
+                self.revalidations += 1
+
+    def delete(self, key: str):
+        """ Removes a cached value if present
+        Args:
+            key: Endpoint path
+
+        """
+        with self._lock:
+            self._delete(key)
+
+    @abc.abstractmethod
+    def clear(self):
+        """Removes every cached value"""
+
+
+class MemoryCache(Cache):
+    """An in memory least recently used cache holding at most maxsize entries. The FHIR class returns a new list of
+    the cached objects on every hit, the Patient and Observation objects themselves are shared so should not be
+    modified"""
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, parsed: bool = True):
+        super().__init__(ttl, parsed)
+        self.maxsize: int = maxsize
+        self._entries: OrderedDict[str, Tuple[Any, float, Optional[Dict[str, str]]]] = collections.OrderedDict()
+
+    def _load(self, key: str) -> Optional[Tuple[Any, float, Optional[Dict[str, str]]]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: str, value: Any, stored: float, validators: Optional[Dict[str, str]]):
+        self._entries[key] = (value, stored, validators)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _delete(self, key: str):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class DiskCache(Cache):
+    """A persistent cache of zlib compressed raw response bodies in an sqlite database, shared between runs. Bodies
+    are returned as bytes, str bodies are stored UTF-8 encoded"""
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        super().__init__(ttl, parsed=False)
+        self.path: str = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                 '(key TEXT PRIMARY KEY, body BLOB, stored REAL, validators TEXT)')
+        self._connection.commit()
+
+    def _load(self, key: str) -> Optional[Tuple[Any, float, Optional[Dict[str, str]]]]:
+        row = self._connection.execute('SELECT body, stored, validators FROM responses WHERE key = ?',
+                                       (key,)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]), row[1], json.loads(row[2]) if row[2] is not None else None
+
+    def _store(self, key: str, value: Any, stored: float, validators: Optional[Dict[str, str]]):
+        body = value.encode('utf-8') if isinstance(value, str) else value
+        self._connection.execute('REPLACE INTO responses (key, body, stored, validators) VALUES (?, ?, ?, ?)',
+                                 (key, zlib.compress(body), stored,
+                                  json.dumps(validators) if validators is not None else None))
+        self._connection.commit()
+
+    def _delete(self, key: str):
+        self._connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+        self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+            self._connection.commit()
+
+    def close(self):
+        """Closes the underlying database"""
+        self._connection.close()
+
+    def __len__(self) -> int:
+        return self._connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
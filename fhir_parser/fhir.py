@@ -4,63 +4,329 @@ FHIR
 The primary component of the FHIR parser with the FHIR class for handling all FHIR endpoint calls
 """
 
+import collections
+import datetime
+import functools
+import json
+import multiprocessing
+import time
 import urllib.parse
-from typing import List
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import requests
 
+from fhir_parser.cache import Cache
 from fhir_parser.observation import Observation
-from fhir_parser.parser import str_to_patient, str_to_error, str_to_patients, str_to_observation, str_to_observations
+from fhir_parser.parser import str_to_patient, str_to_error, str_to_patients, str_to_observation, str_to_observations, \
+    iter_bundle_patients, iter_bundle_observations, has_next_page, page_bundles, iter_stream_resources, dict_to_error, \
+    dict_to_patient, dict_to_observation, last_updated, loads, iter_bundle_patient_observations
 from fhir_parser.patient import Patient
+from fhir_parser.store import Store
+from fhir_parser.transport import RETRY_STATUSES, RateLimiter, StatusError, backoff_delay, retry_after
+
+
+def _parse_page(content: bytes, page: int, parser: Callable, ignore_errors: bool) -> Tuple[list, bool]:
+    bundles = page_bundles(loads(content), page)
+    return list(parser(bundles, ignore_errors=ignore_errors)), len(bundles) > 0 and has_next_page(bundles[-1])
+
+
+def search_path(path: str, search: Optional[Dict[str, Any]] = None) -> str:
+    """ Appends FHIR search parameters to an endpoint path as a URL encoded query, so the server filters and projects
+    the resources rather than the client
+    Args:
+        path: Endpoint path
+        search: Search parameters, a list value repeats the parameter, for example {'code': '8462-4',
+            'date': ['ge2011-01-01', 'lt2012-01-01'], 'category': 'vital-signs', '_count': 50}
+
+    Returns: The path with the query, unchanged if there are no search parameters
+
+    """
+    if not search:
+        return path
+    return path + ('&' if '?' in path else '?') + urllib.parse.urlencode(search, doseq=True)
+
+
+def projected(search: Optional[Dict[str, Any]] = None) -> bool:
+    """
+    Args:
+        search: Search parameters, see search_path
+
+    Returns: Whether the search projects the resources with _elements. Projected resources only hold the requested
+    fields so are always parsed lazily, eagerly decoding the missing fields would fail for every resource
+
+    """
+    return bool(search) and '_elements' in search
+
+
+def _shallow_copy(value: Any) -> Any:
+    # Parsed cache entries are shared, so each caller gets its own lists to modify
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, tuple):
+        return tuple(_shallow_copy(item) for item in value)
+    return value
+
+
+def _validators(response: requests.Response) -> Optional[Dict[str, str]]:
+    validators: Dict[str, str] = {}
+    if 'ETag' in response.headers:
+        validators['If-None-Match'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        validators['If-Modified-Since'] = response.headers['Last-Modified']
+    return validators or None
 
 
 class FHIR:
-    """Create the FHIR endpoint to retrieve patient and observation data"""
+    """Create the FHIR endpoint to retrieve patient and observation data, optionally caching responses by endpoint
+    path in a fhir_parser.cache Cache. Cached responses the server sent an ETag or Last-Modified header for are
+    revalidated with a conditional request once expired, a 304 Not Modified is then served from the cache. With lazy
+    the patients and observations returned only decode each field the first time it is read, results of an _elements
+    search are always parsed lazily. A lazy resource missing a field is skipped with ignore_errors as it would be when
+    parsed eagerly, but only the presence of each field is checked so other corruption raises when the field is read.
+
+    Every request has a (connect, read) timeout in seconds. Connection errors, timeouts and 429 or 5xx responses are
+    retried up to retries times after a jittered exponential backoff, or as long as the server asks with Retry-After.
+    With rate_limit at most that many requests are sent per second across every thread sharing the client."""
 
     def __init__(self, endpoint: str = 'https://localhost:5001/api/', verify_ssl: bool = False,
-                 ignore_errors: bool = True):
+                 ignore_errors: bool = True, pool_size: int = 10, cache: Optional[Cache] = None, lazy: bool = False,
+                 timeout: Optional[Tuple[float, float]] = (10.0, 60.0), retries: int = 3, backoff: float = 0.5,
+                 max_backoff: float = 30.0, rate_limit: Optional[float] = None):
         self.endpoint = endpoint
         self.verify_ssl = verify_ssl
         self.ignore_errors = ignore_errors
+        self.lazy = lazy
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limiter: Optional[RateLimiter] = RateLimiter(rate_limit) if rate_limit else None
         if not self.verify_ssl:
             # noinspection PyUnresolvedReferences
             from requests.packages.urllib3.exceptions import InsecureRequestWarning
             # noinspection PyUnresolvedReferences
             requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+        # A single session keeps connections alive so the TCP/TLS handshake is paid once per host, not per call
+        self.session = requests.Session()
+        self.session.verify = self.verify_ssl
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def __enter__(self) -> 'FHIR':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Closes the underlying session and any pooled connections"""
+        self.session.close()
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        url = urllib.parse.urljoin(self.endpoint, path)
+        for attempt in range(self.retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.retries:
+                    raise
+                time.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+                continue
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                return response
+            response.close()
+            delay = retry_after(response) if response.status_code in (429, 503) else None
+            if delay is None:
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+            elif self.rate_limiter is not None:
+                # The server is throttling the client as a whole, so every thread holds back
+                self.rate_limiter.pause(delay)
+                continue
+            time.sleep(delay)
+
+    def _get(self, path: str, **kwargs) -> requests.Response:
+        return self._request('GET', path, **kwargs)
+
+    def _post(self, path: str, data: dict, **kwargs) -> requests.Response:
+        return self._request('POST', path, data=json.dumps(data), headers={'Content-Type': 'application/fhir+json'},
+                             **kwargs)
+
     def _error_response(self, response):
-        if response.text == '' or response.status_code != 200:
-            raise ConnectionError('Status code: {}'.format(response.status_code))
-        if str_to_error(response.text) is not None:
-            raise ConnectionError(str_to_error(response.text))
+        if response.content == b'' or response.status_code != 200:
+            raise StatusError(response.status_code)
+        # Only bodies that can be an OperationOutcome are decoded, rather than decoding every response twice
+        if b'OperationOutcome' in response.content and str_to_error(response.content) is not None:
+            raise ConnectionError(str_to_error(response.content))
+
+    def _lazily(self, parser: Callable, search: Optional[Dict[str, Any]] = None) -> Callable:
+        return functools.partial(parser, lazy=self.lazy or projected(search))
 
-    def get_all_patients(self) -> List[Patient]:
+    def _ignoring_errors(self, parser: Callable, search: Optional[Dict[str, Any]] = None) -> Callable:
+        return functools.partial(parser, ignore_errors=self.ignore_errors, lazy=self.lazy or projected(search))
+
+    def _checking(self, parser: Callable, search: Optional[Dict[str, Any]] = None) -> Callable:
+        # For single resource parsers whose errors are skipped by the caller, so lazy resources are checked up front
+        return functools.partial(parser, lazy=self.lazy or projected(search), check=self.ignore_errors)
+
+    def _load(self, path: str, parser: Callable, corrupt: str):
+        cached = self.cache.get(path) if self.cache is not None else None
+        if cached is not None and self.cache.parsed:
+            return _shallow_copy(cached)
+        content = cached
+        validators = None
+        if content is None:
+            stale = self.cache.stale(path) if self.cache is not None else None
+            response = self._get(path, headers=stale[1] if stale is not None else None)
+            if response.status_code == 304 and stale is not None:
+                self.cache.revalidate(path)
+                if self.cache.parsed:
+                    return _shallow_copy(stale[0])
+                content = stale[0]
+            else:
+                self._error_response(response)
+                content = response.content
+                validators = _validators(response)
+                if self.cache is not None and not self.cache.parsed:
+                    self.cache.set(path, content, validators)
+        try:
+            parsed = parser(content)
+        except KeyError:
+            raise AttributeError(corrupt)
+        if self.cache is not None and self.cache.parsed:
+            self.cache.set(path, parsed, validators)
+            return _shallow_copy(parsed)
+        return parsed
+
+    def _iter_pages(self, path: str, parser: Callable, corrupt: str, prefetch: int = 0,
+                    processes: Optional[int] = None, search: Optional[Dict[str, Any]] = None) -> Iterator:
+        parser = self._lazily(parser, search)
+        if prefetch > 0 or processes:
+            yield from self._prefetch_pages(path, parser, corrupt, max(prefetch, 1), processes)
+            return
+        page = 1
+        while True:
+            response = self._get(path.format(page))
+            self._error_response(response)
+            bundles = page_bundles(loads(response.content), page)
+            try:
+                yield from parser(bundles, ignore_errors=self.ignore_errors)
+            except KeyError:
+                raise AttributeError(corrupt)
+            if len(bundles) == 0 or not has_next_page(bundles[-1]):
+                return
+            page += 1
+
+    def _prefetch_pages(self, path: str, parser: Callable, corrupt: str, prefetch: int,
+                        processes: Optional[int]) -> Iterator:
+        # Spawned rather than forked workers, forking while the prefetch threads hold locks can deadlock
+        process_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) \
+            if processes else None
+        thread_pool = ThreadPoolExecutor(max_workers=prefetch)
+
+        def fetch(page: int):
+            response = self._get(path.format(page))
+            self._error_response(response)
+            if process_pool is not None:
+                return process_pool.submit(_parse_page, response.content, page, parser, self.ignore_errors)
+            return _parse_page(response.content, page, parser, self.ignore_errors)
+
+        pending: Deque[Future] = collections.deque(thread_pool.submit(fetch, page) for page in range(1, prefetch + 1))
+        page = 1
+        try:
+            while True:
+                result = pending.popleft().result()
+                try:
+                    items, next_page = result.result() if isinstance(result, Future) else result
+                except KeyError:
+                    raise AttributeError(corrupt)
+                if next_page:
+                    pending.append(thread_pool.submit(fetch, page + prefetch))
+                yield from items
+                if not next_page:
+                    return
+                page += 1
+        finally:
+            # Pages requested past the last one are discarded
+            for future in pending:
+                future.cancel()
+            thread_pool.shutdown()
+            if process_pool is not None:
+                process_pool.shutdown()
+
+    def _stream(self, path: str, parser: Callable, corrupt: str, chunk_size: int,
+                search: Optional[Dict[str, Any]] = None) -> Iterator:
+        parser = self._checking(parser, search)
+        with self._get(path, stream=True) as response:
+            if response.status_code != 200:
+                raise StatusError(response.status_code)
+            for resource in iter_stream_resources(response.iter_content(chunk_size=chunk_size)):
+                if dict_to_error(resource) is not None:
+                    raise ConnectionError(dict_to_error(resource))
+                try:
+                    parsed = parser(resource)
+                except Exception as e:
+                    if self.ignore_errors:
+                        continue
+                    if isinstance(e, KeyError):
+                        raise AttributeError(corrupt)
+                    raise e
+                yield parsed
+
+    def get_all_patients(self, search: Optional[Dict[str, Any]] = None) -> List[Patient]:
         """
+        Args:
+            search: Search parameters such as _count or _elements, see search_path
+
         Returns: A list of patients
 
         """
-        response = requests.get(urllib.parse.urljoin(self.endpoint, 'Patient/'), verify=self.verify_ssl)
-        self._error_response(response)
-        try:
-            return str_to_patients(response.text, ignore_errors=self.ignore_errors)
-        except KeyError:
-            raise AttributeError('Patient data is corrupt')
+        return self._load(search_path('Patient/', search), self._ignoring_errors(str_to_patients, search),
+                          'Patient data is corrupt')
+
+    def stream_all_patients(self, chunk_size: int = 65536,
+                            search: Optional[Dict[str, Any]] = None) -> Iterator[Patient]:
+        """ Streams every patient, parsing the response incrementally as it downloads rather than loading it whole
+        Args:
+            chunk_size: Number of bytes to read from the response at a time
+            search: Search parameters such as _count or _elements, see search_path
+
+        Returns: An iterator of patients
+
+        """
+        return self._stream(search_path('Patient/', search), dict_to_patient, 'Patient data is corrupt', chunk_size,
+                            search)
 
-    def get_patient_page(self, page: int) -> List[Patient]:
+    def get_patient_page(self, page: int, search: Optional[Dict[str, Any]] = None) -> List[Patient]:
         """
         Args:
             page: Page number int
+            search: Search parameters such as _count or _elements, see search_path
 
         Returns: A list of patients up to the specified page
 
         """
-        response = requests.get(urllib.parse.urljoin(self.endpoint, 'Patient/pages/' + str(page)),
-                                verify=self.verify_ssl)
-        self._error_response(response)
-        try:
-            return str_to_patients(response.text, ignore_errors=self.ignore_errors)
-        except KeyError:
-            raise AttributeError('Patient data is corrupt')
+        return self._load(search_path('Patient/pages/' + str(page), search),
+                          self._ignoring_errors(str_to_patients, search), 'Patient data is corrupt')
+
+    def iter_patients(self, prefetch: int = 0, processes: Optional[int] = None,
+                      search: Optional[Dict[str, Any]] = None) -> Iterator[Patient]:
+        """ Lazily walks the patient pages, by default only requesting the next page once the current one is consumed
+        Args:
+            prefetch: Number of pages to download in the background while the current page is consumed
+            processes: Number of worker processes to parse pages in, by default pages are parsed in this process
+            search: Search parameters such as _count or _elements, see search_path
+
+        Returns: An iterator of patients
+
+        """
+        return self._iter_pages(search_path('Patient/pages/{}', search), iter_bundle_patients,
+                                'Patient data is corrupt', prefetch, processes, search)
 
     def get_patient(self, id: str) -> Patient:
         """
@@ -70,12 +336,48 @@ class FHIR:
         Returns: A single patient
 
         """
-        response = requests.get(urllib.parse.urljoin(self.endpoint, 'Patient/' + str(id)), verify=self.verify_ssl)
-        self._error_response(response)
-        try:
-            return str_to_patient(response.text)
-        except KeyError:
-            raise AttributeError('Patient data is corrupt')
+        return self._load('Patient/' + str(id), self._lazily(str_to_patient), 'Patient data is corrupt')
+
+    def _batch(self, paths: List[str], parser: Callable, corrupt: str, chunk_size: int) -> Iterator[Tuple[int, object]]:
+        parser = self._checking(parser)
+        for start in range(0, len(paths), chunk_size):
+            chunk = paths[start:start + chunk_size]
+            response = self._post('', {'resourceType': 'Bundle', 'type': 'batch',
+                                       'entry': [{'request': {'method': 'GET', 'url': path}} for path in chunk]})
+            self._error_response(response)
+            entries = loads(response.content).get('entry', [])
+            if len(entries) != len(chunk):
+                raise ConnectionError('Batch response has {} entries for {} requests'.format(len(entries), len(chunk)))
+            for index, entry in enumerate(entries, start):
+                status = entry.get('response', {}).get('status', '200')
+                try:
+                    if not status.startswith('2') or 'resource' not in entry:
+                        error = dict_to_error(entry.get('response', {}).get('outcome', {}))
+                        raise ConnectionError(error if error is not None else 'Status code: {}'.format(status))
+                    try:
+                        parsed = parser(entry['resource'])
+                    except KeyError:
+                        raise AttributeError(corrupt)
+                except Exception as e:
+                    if self.ignore_errors:
+                        continue
+                    raise e
+                yield index, parsed
+
+    def get_patients(self, ids: Iterable[str], chunk_size: int = 100) -> Dict[str, Patient]:
+        """ Fetches many patients with one batch Bundle POST per chunk_size IDs rather than a request each, the
+        entries request the same paths as get_patient. With ignore_errors patients the server could not return or that
+        fail to parse are left out, otherwise the error is raised.
+        Args:
+            ids: Patient IDs or UUID strings
+            chunk_size: Number of patients to request in each batch
+
+        Returns: A dictionary of patient ID to patient, in the order of ids
+
+        """
+        ids = list(dict.fromkeys(map(str, ids)))
+        return {ids[index]: patient for index, patient in self._batch(['Patient/' + id for id in ids], dict_to_patient,
+                                                                      'Patient data is corrupt', chunk_size)}
 
     def get_observation(self, id: str) -> Observation:
         """
@@ -85,43 +387,308 @@ class FHIR:
         Returns: A single observation
 
         """
-        response = requests.get(urllib.parse.urljoin(self.endpoint, 'Observation/single/' + str(id)),
-                                verify=self.verify_ssl)
-        self._error_response(response)
-        try:
-            return str_to_observation(response.text)
-        except KeyError:
-            raise AttributeError('Observation data is corrupt')
+        return self._load('Observation/single/' + str(id), self._lazily(str_to_observation),
+                          'Observation data is corrupt')
+
+    def iter_patients_with_observations(self, prefetch: int = 0, processes: Optional[int] = None,
+                                        search: Optional[Dict[str, Any]] = None) \
+            -> Iterator[Tuple[Patient, List[Observation]]]:
+        """ Walks the patient pages with _revinclude=Observation:subject so each page brings the observations for its
+        patients, rather than a request per patient for their observations
+        Args:
+            prefetch: Number of pages to download in the background while the current page is consumed
+            processes: Number of worker processes to parse pages in, by default pages are parsed in this process
+            search: Further search parameters such as _count, see search_path
+
+        Returns: An iterator of each patient with their observations
+
+        """
+        return self._iter_pages(search_path('Patient/pages/{}', dict(search or {}, _revinclude='Observation:subject')),
+                                iter_bundle_patient_observations, 'Patient data is corrupt', prefetch, processes,
+                                search)
+
+    def get_patients_with_observations(self, prefetch: int = 0, processes: Optional[int] = None,
+                                       search: Optional[Dict[str, Any]] = None) \
+            -> Dict[str, Tuple[Patient, List[Observation]]]:
+        """ Fetches every patient with their observations, see iter_patients_with_observations
+        Args:
+            prefetch: Number of pages to download in the background while the current page is consumed
+            processes: Number of worker processes to parse pages in, by default pages are parsed in this process
+            search: Further search parameters such as _count, see search_path
+
+        Returns: A dictionary of patient UUID to the patient and their observations
+
+        """
+        return {patient.uuid: (patient, observations) for patient, observations in
+                self.iter_patients_with_observations(prefetch, processes, search)}
+
+    def get_patient_everything(self, id: str) -> Tuple[Patient, List[Observation]]:
+        """ Fetches a patient and their observations in one request with Patient/$everything
+        Args:
+            id: Patient ID or UUID string
+
+        Returns: The patient and their observations
 
-    def get_patient_observations(self, id: str) -> List[Observation]:
+        """
+        def parse(content: bytes) -> Tuple[Patient, List[Observation]]:
+            bundles = loads(content)
+            # $everything returns a single bundle, or a bundle list like the other endpoints
+            joined = list(iter_bundle_patient_observations(bundles if isinstance(bundles, list) else [bundles],
+                                                           ignore_errors=self.ignore_errors, lazy=self.lazy))
+            if len(joined) == 0:
+                raise KeyError('Patient')
+            return joined[0]
+
+        return self._load('Patient/' + str(id) + '/$everything', parse, 'Patient data is corrupt')
+
+    def get_observations(self, ids: Iterable[str], chunk_size: int = 100) -> Dict[str, Observation]:
+        """ Fetches many observations with one batch Bundle POST per chunk_size IDs, see get_patients
+        Args:
+            ids: Observation IDs or UUID strings
+            chunk_size: Number of observations to request in each batch
+
+        Returns: A dictionary of observation ID to observation, in the order of ids
+
+        """
+        ids = list(dict.fromkeys(map(str, ids)))
+        return {ids[index]: observation for index, observation in
+                self._batch(['Observation/single/' + id for id in ids], dict_to_observation,
+                            'Observation data is corrupt', chunk_size)}
+
+    def get_patient_observations(self, id: str, search: Optional[Dict[str, Any]] = None) -> List[Observation]:
         """
         Args:
             id: Patient ID or UUID string
+            search: Search parameters such as code, date, category, _count or _elements, see search_path. Results of
+                an _elements search are always parsed lazily, see projected
 
         Returns: A list of observations for a patient
 
         """
-        response = requests.get(urllib.parse.urljoin(self.endpoint, 'Observation/' + str(id)),
-                                verify=self.verify_ssl)
-        self._error_response(response)
-        try:
-            return str_to_observations(response.text, ignore_errors=self.ignore_errors)
-        except KeyError:
-            raise AttributeError('Observation data from patient is corrupt')
+        return self._load(search_path('Observation/' + str(id), search),
+                          self._ignoring_errors(str_to_observations, search),
+                          'Observation data from patient is corrupt')
+
+    def stream_patient_observations(self, id: str, chunk_size: int = 65536,
+                                    search: Optional[Dict[str, Any]] = None) -> Iterator[Observation]:
+        """ Streams the observations for a patient, parsing the response incrementally as it downloads rather than
+        loading it whole
+        Args:
+            id: Patient ID or UUID string
+            chunk_size: Number of bytes to read from the response at a time
+            search: Search parameters such as code, date, category, _count or _elements, see search_path. Results of
+                an _elements search are always parsed lazily, see projected
 
-    def get_patient_observations_page(self, id: str, page: int) -> List[Observation]:
+        Returns: An iterator of observations for a patient
+
+        """
+        return self._stream(search_path('Observation/' + str(id), search), dict_to_observation,
+                            'Observation data from patient is corrupt', chunk_size, search)
+
+    def get_patient_observations_page(self, id: str, page: int,
+                                      search: Optional[Dict[str, Any]] = None) -> List[Observation]:
         """
         Args:
             id: Patient ID or UUID string
             page: Page number int
+            search: Search parameters such as code, date, category, _count or _elements, see search_path. Results of
+                an _elements search are always parsed lazily, see projected
 
         Returns: A list of observations for a patient up to the specified page
 
         """
-        response = requests.get(urllib.parse.urljoin(self.endpoint, 'Observation/pages/' + str(page) + '/' + str(id)),
-                                verify=self.verify_ssl)
+        return self._load(search_path('Observation/pages/' + str(page) + '/' + str(id), search),
+                          self._ignoring_errors(str_to_observations, search),
+                          'Observation data from patient is corrupt')
+
+    def iter_patient_observations(self, id: str, prefetch: int = 0, processes: Optional[int] = None,
+                                  search: Optional[Dict[str, Any]] = None) -> Iterator[Observation]:
+        """ Lazily walks the observation pages for a patient, by default only requesting the next page once the current
+        one is consumed
+        Args:
+            id: Patient ID or UUID string
+            prefetch: Number of pages to download in the background while the current page is consumed
+            processes: Number of worker processes to parse pages in, by default pages are parsed in this process
+            search: Search parameters such as code, date, category, _count or _elements, see search_path. Results of
+                an _elements search are always parsed lazily, see projected
+
+        Returns: An iterator of observations for a patient
+
+        """
+        return self._iter_pages(search_path('Observation/pages/{}/' + str(id), search), iter_bundle_observations,
+                                'Observation data from patient is corrupt', prefetch, processes, search)
+
+    def iter_patients_observations(self, ids: Iterable[str], max_workers: int = 8,
+                                   search: Optional[Dict[str, Any]] = None) -> Iterator[Tuple[str, List[Observation]]]:
+        """ Fetches the observations for many patients concurrently on a thread pool sharing this client's session,
+        yielding each patient's observations as soon as they arrive. Transient failures are retried by the client,
+        see retries. With ignore_errors a patient that still fails is left out, otherwise the error is raised. Use a
+        pool_size of at least max_workers so every worker keeps its connection alive.
+        Args:
+            ids: Patient IDs or UUID strings
+            max_workers: Number of requests in flight at once
+            search: Search parameters for every patient, see get_patient_observations
+
+        Returns: An iterator of (patient ID, list of observations) in completion order
+
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self.get_patient_observations, id, search): id
+                       for id in dict.fromkeys(map(str, ids))}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        observations = future.result()
+                    except Exception as e:
+                        if self.ignore_errors:
+                            continue
+                        raise e
+                    yield futures[future], observations
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def get_patients_observations(self, ids: Iterable[str], max_workers: int = 8,
+                                  search: Optional[Dict[str, Any]] = None) -> Dict[str, List[Observation]]:
+        """ Fetches the observations for many patients concurrently, see iter_patients_observations
+        Args:
+            ids: Patient IDs or UUID strings
+            max_workers: Number of requests in flight at once
+            search: Search parameters for every patient, see get_patient_observations
+
+        Returns: A dictionary of patient ID to the list of observations for that patient, in the order of ids
+
+        """
+        ids = list(dict.fromkeys(map(str, ids)))
+        results = dict(self.iter_patients_observations(ids, max_workers=max_workers, search=search))
+        return {id: results[id] for id in ids if id in results}
+
+    def _sync(self, path: str, parser: Callable, corrupt: str, since: Union[str, datetime.datetime, None]) \
+            -> Tuple[list, Optional[str]]:
+        if isinstance(since, datetime.datetime):
+            since = since.isoformat()
+        response = self._get(path, params={'_since': since} if since is not None else None)
         self._error_response(response)
+        bundles = loads(response.content)
         try:
-            return str_to_observations(response.text, ignore_errors=self.ignore_errors)
+            parsed = list(parser(bundles, ignore_errors=self.ignore_errors, lazy=self.lazy))
         except KeyError:
-            raise AttributeError('Observation data from patient is corrupt')
+            raise AttributeError(corrupt)
+        return parsed, last_updated(bundles) or since
+
+    def sync_patients(self, store: Store, since: Union[str, datetime.datetime, None] = None) -> Optional[str]:
+        """ Fetches only the patients changed since the last sync with the _since search parameter and merges them into
+        the store, replacing patients already held by UUID. Pass the returned high-water mark as since on the next
+        run, a Snapshot can be kept in step by loading it into the store and writing the store back out.
+        Args:
+            store: Store to merge the patients into
+            since: High-water mark returned by the last sync, every patient is fetched if None
+
+        Returns: The new high-water mark, the latest lastUpdated of the patients fetched or since if there were none
+
+        """
+        patients, mark = self._sync('Patient/', iter_bundle_patients, 'Patient data is corrupt', since)
+        store.add_patients(patients)
+        return mark
+
+    def sync_patient_observations(self, id: str, store: Store,
+                                  since: Union[str, datetime.datetime, None] = None) -> Optional[str]:
+        """ Fetches only the observations for a patient changed since the last sync with the _since search parameter
+        and merges them into the store, replacing observations already held by UUID, see sync_patients
+        Args:
+            id: Patient ID or UUID string
+            store: Store to merge the observations into
+            since: High-water mark returned by the last sync, every observation is fetched if None
+
+        Returns: The new high-water mark, the latest lastUpdated (or issued time) of the observations fetched or since
+        if there were none
+
+        """
+        observations, mark = self._sync('Observation/' + str(id), iter_bundle_observations,
+                                        'Observation data from patient is corrupt', since)
+        store.add_observations(observations)
+        return mark
+
+    def export_manifest(self, types: Iterable[str] = ('Patient', 'Observation'),
+                        since: Union[str, datetime.datetime, None] = None, poll_interval: float = 1.0,
+                        timeout: Optional[float] = None) -> dict:
+        """ Kicks off a FHIR Bulk Data export of the patients and their compartments with Patient/$export and polls the
+        status URL until the NDJSON files are ready, waiting as long as the server asks with Retry-After
+        Args:
+            types: Resource types to export
+            since: Only export resources changed since, for example the transactionTime of the last manifest
+            poll_interval: Seconds between status requests when the server does not send Retry-After
+            timeout: Seconds to wait for the export to complete, forever if None
+
+        Returns: The completion manifest, output lists the type and url of each NDJSON file
+
+        """
+        if isinstance(since, datetime.datetime):
+            since = since.isoformat()
+        params = {'_type': ','.join(types)}
+        if since is not None:
+            params['_since'] = since
+        headers = {'Accept': 'application/fhir+json', 'Prefer': 'respond-async'}
+        response = self._get('Patient/$export', params=params, headers=headers)
+        if response.status_code != 202 or 'Content-Location' not in response.headers:
+            self._error_response(response)
+            raise StatusError(response.status_code)
+        status = response.headers['Content-Location']
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            response = self._get(status, headers={'Accept': 'application/json'})
+            if response.status_code != 202:
+                self._error_response(response)
+                return loads(response.content)
+            delay = retry_after(response)
+            delay = delay if delay is not None else poll_interval
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError('Export did not complete within {} seconds'.format(timeout))
+            time.sleep(delay)
+
+    def iter_export(self, manifest: dict, chunk_size: int = 65536) -> Iterator[Union[Patient, Observation]]:
+        """ Streams the NDJSON files of a completed export, parsing each line as it downloads
+        Args:
+            manifest: Completion manifest from export_manifest
+            chunk_size: Number of bytes to read from each file at a time
+
+        Returns: An iterator of the patients and observations in the files, other resource types are skipped
+
+        """
+        parsers = {'Patient': (self._checking(dict_to_patient), 'Patient data is corrupt'),
+                   'Observation': (self._checking(dict_to_observation), 'Observation data is corrupt')}
+        for output in manifest.get('output', []):
+            if output['type'] not in parsers:
+                continue
+            parser, corrupt = parsers[output['type']]
+            with self._get(output['url'], stream=True, headers={'Accept': 'application/fhir+ndjson'}) as response:
+                if response.status_code != 200:
+                    raise StatusError(response.status_code)
+                for line in response.iter_lines(chunk_size=chunk_size):
+                    if not line:
+                        continue
+                    try:
+                        parsed = parser(loads(line))
+                    except Exception as e:
+                        if self.ignore_errors:
+                            continue
+                        if isinstance(e, KeyError):
+                            raise AttributeError(corrupt)
+                        raise e
+                    yield parsed
+
+    def bulk_export(self, types: Iterable[str] = ('Patient', 'Observation'),
+                    since: Union[str, datetime.datetime, None] = None, poll_interval: float = 1.0,
+                    timeout: Optional[float] = None) -> Iterator[Union[Patient, Observation]]:
+        """ Moves a whole population with the FHIR Bulk Data export rather than paging, see export_manifest and
+        iter_export. Use export_manifest directly to keep the transactionTime as the since of the next export.
+        Args:
+            types: Resource types to export
+            since: Only export resources changed since
+            poll_interval: Seconds between status requests when the server does not send Retry-After
+            timeout: Seconds to wait for the export to complete, forever if None
+
+        Returns: An iterator of the exported patients and observations
+
+        """
+        return self.iter_export(self.export_manifest(types, since, poll_interval, timeout))
@@ -0,0 +1,415 @@
+"""
+Frame
+=====
+Columnar containers holding many patients or observations as NumPy arrays for vectorised aggregation, requires numpy
+"""
+
+import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+
+from fhir_parser.observation import Observation
+from fhir_parser.parser import iter_bundle_observations, iter_bundle_patients
+from fhir_parser.patient import Patient
+
+
+class Categorical:
+    """A column of repeated strings stored once in categories, each row holds an int32 index into categories"""
+    __slots__ = ('codes', 'categories')
+
+    def __init__(self, codes: np.ndarray, categories: np.ndarray):
+        self.codes: np.ndarray = codes
+        self.categories: np.ndarray = categories
+
+    @classmethod
+    def from_values(cls, values: Iterable[Optional[str]]) -> 'Categorical':
+        """
+        Args:
+            values: The value of each row
+
+        Returns: The categorical encoding of the values
+
+        """
+        lookup: Dict[Optional[str], int] = {}
+        codes = np.fromiter((lookup.setdefault(value, len(lookup)) for value in values), dtype=np.int32)
+        categories = np.empty(len(lookup), dtype=object)
+        categories[:] = list(lookup)
+        return cls(codes, categories)
+
+    @classmethod
+    def concat(cls, columns: List['Categorical']) -> 'Categorical':
+        """
+        Args:
+            columns: Categorical columns, each with its own categories
+
+        Returns: The rows of every column in order, with the categories merged
+
+        """
+        lookup: Dict[Optional[str], int] = {}
+        codes = [np.fromiter((lookup.setdefault(value, len(lookup)) for value in column.categories.tolist()),
+                             dtype=np.int32, count=len(column.categories))[column.codes] for column in columns]
+        categories = np.empty(len(lookup), dtype=object)
+        categories[:] = list(lookup)
+        return cls(np.concatenate(codes) if codes else np.empty(0, dtype=np.int32), categories)
+
+    def values(self) -> np.ndarray:
+        """
+        Returns: The value of each row as an object array
+
+        """
+        return self.categories[self.codes]
+
+    def take(self, index: np.ndarray) -> 'Categorical':
+        return Categorical(self.codes[index], self.categories)
+
+    def value_counts(self) -> Dict[str, int]:
+        """
+        Returns: The number of rows for each value, most common first
+
+        """
+        counts = np.bincount(self.codes, minlength=len(self.categories))
+        order = np.argsort(-counts, kind='stable')
+        order = order[counts[order] > 0]
+        return dict(zip(self.categories[order].tolist(), counts[order].tolist()))
+
+    def isin(self, values: Iterable[Optional[str]]) -> np.ndarray:
+        """ Matches the values against the categories once, then selects rows by their int32 index
+        Args:
+            values: Values to match
+
+        Returns: Boolean mask of the rows holding one of the values, invert it with ~ for the other rows
+
+        """
+        matches = np.flatnonzero(np.isin(self.categories, np.array(list(values), dtype=object)))
+        return np.isin(self.codes, matches)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+
+def to_datetime64(value: Union[datetime.datetime, np.datetime64, None]) -> np.datetime64:
+    """ Converts a datetime to a naive UTC numpy datetime64 with microsecond precision
+    Args:
+        value: Aware or naive datetime, naive datetimes are taken to already be UTC
+
+    Returns: The numpy datetime64, NaT for None
+
+    """
+    if value is None:
+        return np.datetime64('NaT', 'us')
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, 'us')
+
+
+def decoded(items: Iterable, fields: List[str], ignore_errors: bool = False) -> Iterator:
+    """ Reads the fields a frame holds from each lazy patient or observation, so a corrupt field fails here rather
+    than part way through building the frame
+    Args:
+        items: Lazy patients or observations
+        fields: Attribute names to decode
+        ignore_errors: Skip items with a field that fails to decode
+
+    Returns: An iterator of the items with the fields decoded
+
+    """
+    for item in items:
+        try:
+            for field in fields:
+                getattr(item, field)
+        except Exception as e:
+            if ignore_errors:
+                continue
+            raise e
+        yield item
+
+
+class GroupBy:
+    """Rows grouped by the categories of a column, aggregating a float64 array of values where nan is missing"""
+    def __init__(self, column: Categorical, values: np.ndarray):
+        self.column: Categorical = column
+        self.values: np.ndarray = values
+
+    def _aggregate(self, totals: np.ndarray) -> Dict[str, float]:
+        sizes = np.bincount(self.column.codes, minlength=len(self.column.categories))
+        present = np.flatnonzero(sizes)
+        return dict(zip(self.column.categories[present].tolist(), totals[present].tolist()))
+
+    def _bincount(self, weighted: bool) -> np.ndarray:
+        valid = ~np.isnan(self.values)
+        return np.bincount(self.column.codes[valid], weights=self.values[valid] if weighted else None,
+                           minlength=len(self.column.categories))
+
+    def size(self) -> Dict[str, int]:
+        """
+        Returns: The number of rows in each group
+
+        """
+        return self._aggregate(np.bincount(self.column.codes, minlength=len(self.column.categories)))
+
+    def count(self) -> Dict[str, int]:
+        """
+        Returns: The number of values in each group
+
+        """
+        return self._aggregate(self._bincount(False))
+
+    def sum(self) -> Dict[str, float]:
+        """
+        Returns: The sum of the values in each group
+
+        """
+        return self._aggregate(self._bincount(True))
+
+    def mean(self) -> Dict[str, float]:
+        """
+        Returns: The mean of the values in each group, nan for groups without any
+
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._aggregate(self._bincount(True) / self._bincount(False))
+
+
+class ObservationFrame:
+    """Observations held column wise with one row per observation component. Strings are categorical, values are a
+    float64 array (nan where the component has no numeric value) and effective times a UTC datetime64 array"""
+    CATEGORICAL: List[str] = ['patient_uuid', 'uuid', 'type', 'code', 'display', 'unit']
+    # Observation attributes read when building the frame
+    FIELDS: List[str] = ['uuid', 'type', 'patient_uuid', 'effective_datetime', 'components']
+
+    def __init__(self, patient_uuid: Categorical, uuid: Categorical, type: Categorical, code: Categorical,
+                 display: Categorical, unit: Categorical, value: np.ndarray, effective: np.ndarray):
+        self.patient_uuid: Categorical = patient_uuid
+        self.uuid: Categorical = uuid
+        self.type: Categorical = type
+        self.code: Categorical = code
+        self.display: Categorical = display
+        self.unit: Categorical = unit
+        self.value: np.ndarray = value
+        self.effective: np.ndarray = effective
+
+    @classmethod
+    def from_observations(cls, observations: Iterable[Observation]) -> 'ObservationFrame':
+        """
+        Args:
+            observations: Observations, for example from str_to_observations or FHIR.iter_patient_observations
+
+        Returns: The observation frame
+
+        """
+        columns: Dict[str, list] = {name: [] for name in cls.CATEGORICAL + ['value', 'effective']}
+        for observation in observations:
+            effective = to_datetime64(observation.effective_datetime)
+            for component in observation.components:
+                columns['patient_uuid'].append(observation.patient_uuid)
+                columns['uuid'].append(observation.uuid)
+                columns['type'].append(observation.type)
+                columns['code'].append(component.code)
+                columns['display'].append(component.display)
+                columns['unit'].append(component.unit)
+                columns['value'].append(component.value if isinstance(component.value, (int, float)) else np.nan)
+                columns['effective'].append(effective)
+        return cls(*[Categorical.from_values(columns[name]) for name in cls.CATEGORICAL],
+                   np.array(columns['value'], dtype=np.float64), np.array(columns['effective'], dtype='datetime64[us]'))
+
+    @classmethod
+    def from_bundles(cls, bundles: List[dict], ignore_errors: bool = False) -> 'ObservationFrame':
+        """ Builds the frame straight from bundle dicts, only decoding the fields the frame holds
+        Args:
+            bundles: Decoded observation bundle list
+            ignore_errors: Skip observations that fail to parse
+
+        Returns: The observation frame
+
+        """
+        return cls.from_observations(decoded(iter_bundle_observations(bundles, ignore_errors=ignore_errors, lazy=True),
+                                             cls.FIELDS, ignore_errors))
+
+    @classmethod
+    def concat(cls, frames: List['ObservationFrame']) -> 'ObservationFrame':
+        """
+        Args:
+            frames: Observation frames, for example built from separate pages or files
+
+        Returns: The rows of every frame in order
+
+        """
+        if not frames:
+            return cls.from_observations([])
+        return cls(*[Categorical.concat([getattr(frame, name) for frame in frames]) for name in cls.CATEGORICAL],
+                   np.concatenate([frame.value for frame in frames]),
+                   np.concatenate([frame.effective for frame in frames]))
+
+    def __len__(self) -> int:
+        return len(self.value)
+
+    def __getitem__(self, index: np.ndarray) -> 'ObservationFrame':
+        """ Selects rows
+        Args:
+            index: Boolean mask or integer indices
+
+        Returns: The observation frame of the selected rows
+
+        """
+        return ObservationFrame(*[getattr(self, name).take(index) for name in self.CATEGORICAL], self.value[index],
+                                self.effective[index])
+
+    def value_counts(self, column: str = 'code') -> Dict[str, int]:
+        """
+        Args:
+            column: Categorical column name
+
+        Returns: The number of rows for each value of the column, most common first
+
+        """
+        return getattr(self, column).value_counts()
+
+    def groupby(self, column: str = 'code') -> GroupBy:
+        """
+        Args:
+            column: Categorical column name
+
+        Returns: The rows grouped by the values of the column, aggregating the numeric values
+
+        """
+        return GroupBy(getattr(self, column), self.value)
+
+    def between(self, start: Union[datetime.datetime, np.datetime64, None] = None,
+                end: Union[datetime.datetime, np.datetime64, None] = None) -> 'ObservationFrame':
+        """
+        Args:
+            start: Earliest effective time included, unbounded if None
+            end: Effective time before which rows are included, unbounded if None
+
+        Returns: The observation frame of rows with an effective time in [start, end)
+
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.effective >= to_datetime64(start)
+        if end is not None:
+            mask &= self.effective < to_datetime64(end)
+        return self[mask]
+
+
+class PatientFrame:
+    """Patients held column wise with one row per patient. Birth dates are a datetime64 array, gender and marital
+    status categorical, languages a flat categorical with language_offsets marking where each patient's languages
+    start, and latitude and longitude (of the first address that has them) float64 arrays with nan where missing"""
+    # Patient attributes read when building the frame
+    FIELDS: List[str] = ['uuid', 'birth_date', 'gender', 'marital_status', 'communications', 'addresses']
+
+    def __init__(self, uuid: np.ndarray, birth_date: np.ndarray, gender: Categorical, marital_status: Categorical,
+                 languages: Categorical, language_offsets: np.ndarray, latitude: np.ndarray, longitude: np.ndarray):
+        self.uuid: np.ndarray = uuid
+        self.birth_date: np.ndarray = birth_date
+        self.gender: Categorical = gender
+        self.marital_status: Categorical = marital_status
+        self.languages: Categorical = languages
+        self.language_offsets: np.ndarray = language_offsets
+        self.latitude: np.ndarray = latitude
+        self.longitude: np.ndarray = longitude
+
+    @classmethod
+    def from_patients(cls, patients: Iterable[Patient]) -> 'PatientFrame':
+        """
+        Args:
+            patients: Patients, for example from str_to_patients or FHIR.iter_patients
+
+        Returns: The patient frame
+
+        """
+        uuids, birth_dates, genders, marital_statuses, languages, latitudes, longitudes = [], [], [], [], [], [], []
+        offsets: List[int] = [0]
+        for patient in patients:
+            uuids.append(patient.uuid)
+            birth_dates.append(patient.birth_date)
+            genders.append(patient.gender)
+            marital_statuses.append(patient.marital_status.marital_status)
+            languages.extend(patient.communications.languages)
+            offsets.append(len(languages))
+            located = [a for a in patient.addresses if a.latitude is not None and a.longitude is not None]
+            latitudes.append(located[0].latitude if located else np.nan)
+            longitudes.append(located[0].longitude if located else np.nan)
+        uuid = np.empty(len(uuids), dtype=object)
+        uuid[:] = uuids
+        return cls(uuid, np.array(birth_dates, dtype='datetime64[D]'), Categorical.from_values(genders),
+                   Categorical.from_values(marital_statuses), Categorical.from_values(languages),
+                   np.array(offsets, dtype=np.int64), np.array(latitudes, dtype=np.float64),
+                   np.array(longitudes, dtype=np.float64))
+
+    @classmethod
+    def from_bundles(cls, bundles: List[dict], ignore_errors: bool = False) -> 'PatientFrame':
+        """ Builds the frame straight from bundle dicts, only decoding the fields the frame holds
+        Args:
+            bundles: Decoded patient bundle list
+            ignore_errors: Skip patients that fail to parse
+
+        Returns: The patient frame
+
+        """
+        return cls.from_patients(decoded(iter_bundle_patients(bundles, ignore_errors=ignore_errors, lazy=True),
+                                         cls.FIELDS, ignore_errors))
+
+    @classmethod
+    def concat(cls, frames: List['PatientFrame']) -> 'PatientFrame':
+        """
+        Args:
+            frames: Patient frames, for example built from separate pages or files
+
+        Returns: The rows of every frame in order
+
+        """
+        if not frames:
+            return cls.from_patients([])
+        offsets = [frames[0].language_offsets]
+        total = frames[0].language_offsets[-1]
+        for frame in frames[1:]:
+            offsets.append(frame.language_offsets[1:] + total)
+            total += frame.language_offsets[-1]
+        return cls(np.concatenate([frame.uuid for frame in frames]),
+                   np.concatenate([frame.birth_date for frame in frames]),
+                   Categorical.concat([frame.gender for frame in frames]),
+                   Categorical.concat([frame.marital_status for frame in frames]),
+                   Categorical.concat([frame.languages for frame in frames]), np.concatenate(offsets),
+                   np.concatenate([frame.latitude for frame in frames]),
+                   np.concatenate([frame.longitude for frame in frames]))
+
+    def __len__(self) -> int:
+        return len(self.uuid)
+
+    def ages(self, reference: Optional[datetime.date] = None) -> np.ndarray:
+        """ Computes every age at once relative to a single reference date, matching Patient.age
+        Args:
+            reference: Date to compute the ages at, today if None
+
+        Returns: A float64 array of ages in years
+
+        """
+        reference = np.datetime64(reference or datetime.date.today(), 'D')
+        ages = (reference - self.birth_date).astype(np.float64) / 365.25
+        ages[np.isnat(self.birth_date)] = np.nan
+        return ages
+
+    def histogram(self, column: str = 'gender') -> Dict[str, int]:
+        """
+        Args:
+            column: gender, marital_status or languages
+
+        Returns: The number of patients for each value of the column, most common first. Patients speaking several
+        languages are counted once for each.
+
+        """
+        return getattr(self, column).value_counts()
+
+    def groupby(self, column: str = 'gender', values: Optional[np.ndarray] = None) -> GroupBy:
+        """
+        Args:
+            column: gender or marital_status
+            values: A float64 array with a value per patient to aggregate, the ages today if None
+
+        Returns: The patients grouped by the values of the column
+
+        """
+        return GroupBy(getattr(self, column), self.ages() if values is None else values)
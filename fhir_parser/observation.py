@@ -10,6 +10,8 @@ from typing import List, Union, Optional
 
 class ObservationComponent:
     """An observation component object containing the details of a part of the observation"""
+    __slots__ = ('system', 'code', 'display', 'value', 'unit')
+
     def __init__(self, system: str, code: str, display: str, value: Optional[Union[str, float]], unit: Optional[str]):
         self.system: str = system
         self.code: str = code
@@ -27,7 +29,7 @@ class ObservationComponent:
     def __eq__(self, o: object) -> bool:
         if type(o) != ObservationComponent:
             return False
-        return self.__dict__ == o.__dict__
+        return all(getattr(self, slot) == getattr(o, slot) for slot in self.__slots__)
 
     def __str__(self) -> str:
         return self.display + ': ' + str(self.value if self.value is not None else 'N/A') + (self.unit if self.unit is not None else '')
@@ -35,6 +37,9 @@ class ObservationComponent:
 
 class Observation:
     """An observation object holding either one or more observation components"""
+    __slots__ = ('uuid', 'type', 'status', 'patient_uuid', 'encounter_uuid', 'effective_datetime', 'issued_datetime',
+                 'components')
+
     def __init__(self, uuid: str, type: str, status: str, patient_uuid: str, encounter_uuid: str,
                  effective_datetime: datetime.datetime, issued_datetime: datetime.datetime,
                  components: List[ObservationComponent]):
@@ -1,35 +1,151 @@
+import codecs
 import datetime
 import dateutil.parser
+import functools
+import importlib
 import json
-from typing import List, Optional, Union
+import re
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, Union
 
 from fhir_parser.observation import Observation, ObservationComponent
 from fhir_parser.patient import Patient, Name, Telecom, Address, Extension, MaritalStatus, Communications, Identifier
 
+# JSON decoders by preference, orjson and ujson decode bytes directly so response bodies need not be decoded to str
+_JSON_BACKENDS: List[str] = ['orjson', 'ujson', 'json']
+_json_loads: Callable[[Union[str, bytes]], Any] = json.loads
+JSON_BACKEND: str = 'json'
+
+
+def set_json_backend(name: Optional[str] = None) -> str:
+    """ Selects the JSON decoder used by the parsers, the fastest installed one is selected at import
+    Args:
+        name: orjson, ujson or json (the standard library), the first of these that is installed if None
+
+    Returns: The name of the backend selected
+
+    """
+    global _json_loads, JSON_BACKEND
+    if name is not None and name not in _JSON_BACKENDS:
+        raise ValueError('Unknown JSON backend {}'.format(name))
+    for backend in [name] if name is not None else _JSON_BACKENDS:
+        try:
+            module = importlib.import_module(backend)
+        except ImportError:
+            if name is not None:
+                raise ImportError('The {} JSON backend is not installed'.format(name))
+            continue
+        _json_loads = module.loads
+        JSON_BACKEND = backend
+        return backend
+    raise ImportError('No JSON backend is installed')
+
+
+def loads(input: Union[str, bytes]) -> Any:
+    """
+    Args:
+        input: JSON string or UTF-8 bytes
+
+    Returns: The decoded JSON using the selected backend
+
+    """
+    return _json_loads(input)
+
+
+set_json_backend()
+
+
+INTERN_POOL_SIZE: int = 65536
+_intern_pool: Dict[Hashable, Any] = {}
+_marital_statuses: Dict[str, MaritalStatus] = {}
+
+
+def intern_value(input: Hashable) -> Any:
+    """ Returns the shared copy of a value that repeats across a population, such as a code, system, unit or display,
+    so millions of resources hold references to one string instead of their own copies. The pool stops growing once
+    it holds INTERN_POOL_SIZE values, later values are then returned as they are.
+    Args:
+        input: String or tuple of strings
+
+    Returns: The pooled value equal to input
+
+    """
+    pooled = _intern_pool.get(input)
+    if pooled is not None:
+        return pooled
+    if len(_intern_pool) < INTERN_POOL_SIZE:
+        _intern_pool[input] = input
+    return input
+
+
+def clear_intern_pool():
+    """Empties the pool of shared values and marital statuses"""
+    _intern_pool.clear()
+    _marital_statuses.clear()
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_date(input: str) -> datetime.date:
+    """ Parses a FHIR date, using datetime.date.fromisoformat for full dates and dateutil for partial dates such as
+    1998 or 1998-08. Results are memoised as birth dates repeat across a population.
+    Args:
+        input: FHIR date string
+
+    Returns: The date
+
+    """
+    try:
+        return datetime.date.fromisoformat(input)
+    except ValueError:
+        return dateutil.parser.isoparse(input).date()
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_datetime(input: str) -> datetime.datetime:
+    """ Parses a FHIR dateTime or instant, using datetime.datetime.fromisoformat for the usual formats and dateutil
+    for anything else. Results are memoised as timestamps repeat across the observations of an encounter.
+    Args:
+        input: FHIR dateTime or instant string
+
+    Returns: The datetime
+
+    """
+    try:
+        return datetime.datetime.fromisoformat(input[:-1] + '+00:00' if input.endswith('Z') else input)
+    except ValueError:
+        return dateutil.parser.isoparse(input)
+
+
+def json_to_name(input: dict) -> Name:
+    return Name(input['name'][0]['family'], input['name'][0]['given'], input['name'][0]['prefix'] if 'prefix' in input['name'][0] else '')
+
+
+def json_to_telecoms(input: dict) -> List[Telecom]:
+    return [Telecom(intern_value(x['system']), x['value'], intern_value(x['use'])) for x in input['telecom']]
 
-def str_to_patient(input: str) -> Patient:
-    input = json.loads(input)
-    # Verify resource type
-    if not input['resourceType'] == 'Patient':
-        raise AssertionError('Not a patient resource type')
 
-    uuid: str = input['id']
-    name: Name = Name(input['name'][0]['family'], input['name'][0]['given'], input['name'][0]['prefix'] if 'prefix' in input['name'][0] else '')
-    telecoms: List[Telecom] = [Telecom(x['system'], x['value'], x['use']) for x in input['telecom']]
-    gender: str = input['gender']
-    birth_date: datetime.date = dateutil.parser.isoparse(input['birthDate']).date()
-    addresses: List[Address] = [Address(x['line'], x['city'], x['state'], x['postalCode'] if 'postalCode' in x else '', x['country'],
-                                        [Extension(y['url'], y['valueDecimal']) for y in
-                                         x['extension'][0]['extension']])
-                                for x in input['address']]
-    marital_status: MaritalStatus = MaritalStatus(input['maritalStatus']['coding'][0]['code'])
-    multiple_birth: bool = input['multipleBirthBoolean'] if 'multipleBirthBoolean' in input else False
-    communications: Communications = Communications(
-        [(x['language']['coding'][0]['code'], x['language']['coding'][0]['display']) for x in input['communication']])
+def json_to_addresses(input: dict) -> List[Address]:
+    return [Address(x['line'], x['city'], x['state'], x['postalCode'] if 'postalCode' in x else '', x['country'],
+                    [Extension(y['url'], y['valueDecimal']) for y in x['extension'][0]['extension']])
+            for x in input['address']]
 
+
+def json_to_marital_status(input: dict) -> MaritalStatus:
+    # One instance is shared by every patient with the same code, so it must not be modified
+    code: str = input['maritalStatus']['coding'][0]['code']
+    if code not in _marital_statuses:
+        _marital_statuses[code] = MaritalStatus(code)
+    return _marital_statuses[code]
+
+
+def json_to_communications(input: dict) -> Communications:
+    return Communications([intern_value((x['language']['coding'][0]['code'], x['language']['coding'][0]['display']))
+                           for x in input['communication']])
+
+
+def json_to_extensions(input: dict) -> List[Extension]:
     extensions: List[Extension] = []
     for extension in input['extension']:
-        url: str = extension['url'].split('/')[-1]
+        url: str = intern_value(extension['url'].split('/')[-1])
         value: str = ''
         if 'valueString' in extension:
             value = extension['valueString']
@@ -45,68 +161,167 @@ def str_to_patient(input: str) -> Patient:
                     value = e['valueString']
                     break
         extensions.append(Extension(url, value))
+    return extensions
 
+
+def json_to_identifiers(input: dict) -> List[Identifier]:
     identifiers: List[Identifier] = []
     for identifier in input['identifier']:
         identifiers.append(
-            Identifier(identifier['system'], identifier['type']['coding'][0]['code'] if 'type' in identifier else '',
-                       identifier['type']['text'] if 'type' in identifier else '',
+            Identifier(intern_value(identifier['system']),
+                       intern_value(identifier['type']['coding'][0]['code']) if 'type' in identifier else '',
+                       intern_value(identifier['type']['text']) if 'type' in identifier else '',
                        identifier['value']))
+    return identifiers
 
-    return Patient(uuid, name, telecoms, gender, birth_date, addresses, marital_status, multiple_birth, communications,
-                   extensions, identifiers)
 
+_PATIENT_FIELDS: Dict[str, Callable[[dict], Any]] = {
+    'uuid': lambda input: input['id'],
+    'name': json_to_name,
+    'telecoms': json_to_telecoms,
+    'gender': lambda input: intern_value(input['gender']),
+    'birth_date': lambda input: parse_date(input['birthDate']),
+    'addresses': json_to_addresses,
+    'marital_status': json_to_marital_status,
+    'multiple_birth': lambda input: input['multipleBirthBoolean'] if 'multipleBirthBoolean' in input else False,
+    'communications': json_to_communications,
+    'extensions': json_to_extensions,
+    'identifiers': json_to_identifiers,
+}
 
-def str_to_patients(input: str, ignore_errors: bool = False) -> List[Patient]:
-    input = json.loads(input)
 
-    patients: List[Patient] = []
+# The top level keys the fields of a patient need, multipleBirthBoolean is optional
+_PATIENT_KEYS: List[str] = ['id', 'name', 'telecom', 'gender', 'birthDate', 'address', 'maritalStatus',
+                            'communication', 'extension', 'identifier']
+
+
+def _check_keys(input: dict, keys: List[str]):
+    """ Raises a KeyError for the first missing key, so a lazy resource that would fail when read is skipped or
+    reported when parsed. Resources the server tagged SUBSETTED, as it does for an _elements search, are only
+    missing the fields that were not requested so are not checked.
+    Args:
+        input: Resource dict
+        keys: The top level keys the fields need
+
+    """
+    if any(tag.get('code') == 'SUBSETTED' for tag in input.get('meta', {}).get('tag', [])):
+        return
+    for key in keys:
+        if key not in input:
+            raise KeyError(key)
+
+
+def _lazy_field(name: str, decoder: Callable[[dict], Any]) -> property:
+    def get(self):
+        if name not in self.__dict__:
+            self.__dict__[name] = decoder(self.resource)
+        return self.__dict__[name]
+
+    def set(self, value):
+        self.__dict__[name] = value
+
+    return property(get, set)
+
+
+class LazyPatient(Patient):
+    """A patient wrapping the raw resource dict, each field is only decoded the first time it is read so parse time
+    and memory scale with the fields used. Corrupt fields raise when read rather than when parsed, unless parsed with
+    check (as parsers skipping errors do) which raises a KeyError for a missing field up front."""
+    def __init__(self, resource: dict):
+        self.resource: dict = resource
+
+
+for _name, _decoder in _PATIENT_FIELDS.items():
+    setattr(LazyPatient, _name, _lazy_field(_name, _decoder))
+
+
+def str_to_patient(input: Union[str, bytes], lazy: bool = False) -> Patient:
+    return dict_to_patient(loads(input), lazy=lazy)
+
+
+def dict_to_patient(input: dict, lazy: bool = False, check: bool = False) -> Patient:
+    # Verify resource type
+    if not input['resourceType'] == 'Patient':
+        raise AssertionError('Not a patient resource type')
+
+    if lazy:
+        # Lazy patients only fail when a field is read, unless the keys are checked up front
+        if check:
+            _check_keys(input, _PATIENT_KEYS)
+        return LazyPatient(input)
+    return Patient(**{name: decoder(input) for name, decoder in _PATIENT_FIELDS.items()})
+
+
+def str_to_patients(input: Union[str, bytes], ignore_errors: bool = False, lazy: bool = False) -> List[Patient]:
+    return list(iter_bundle_patients(loads(input), ignore_errors=ignore_errors, lazy=lazy))
+
+
+def iter_bundle_patients(input: List[dict], ignore_errors: bool = False, lazy: bool = False) -> Iterator[Patient]:
     for i in input:
-        for p in i['entry']:
+        for p in i.get('entry', []):
             try:
-                patients.append(str_to_patient(json.dumps(p['resource'])))
+                patient = dict_to_patient(p['resource'], lazy=lazy, check=ignore_errors)
             except Exception as e:
                 if ignore_errors:
-                    pass
+                    continue
                 else:
                     raise e
-    return patients
+            yield patient
+
+
+def has_next_page(input: dict) -> bool:
+    return any(link['relation'] == 'next' for link in input.get('link', []))
+
 
-def str_to_error(input: str) -> Optional[str]:
-    input = json.loads(input)
+def page_bundles(input: List[dict], page: int) -> List[dict]:
+    # Servers either return the requested page on its own or every page up to it, skip any already seen
+    return input[page - 1:] if len(input) >= page else input
+
+
+def last_updated(input: List[dict]) -> Optional[str]:
+    """
+    Args:
+        input: Bundle list
+
+    Returns: The latest meta.lastUpdated of the bundle entries, falling back to the issued time of entries without
+    one, None if there are no entries
+
+    """
+    latest: Optional[str] = None
+    for bundle in input:
+        for entry in bundle.get('entry', []):
+            resource = entry['resource']
+            updated = resource.get('meta', {}).get('lastUpdated', resource.get('issued'))
+            if updated is not None and (latest is None or parse_datetime(updated) > parse_datetime(latest)):
+                latest = updated
+    return latest
+
+
+def str_to_error(input: Union[str, bytes]) -> Optional[str]:
+    return dict_to_error(loads(input))
+
+
+def dict_to_error(input: dict) -> Optional[str]:
     if 'resourceType' in input and input['resourceType'] == 'OperationOutcome' and 'issue' in input:
         return input['issue'][0]['diagnostics']
     return None
 
 
 def json_to_observation_component(input) -> ObservationComponent:
-    system: str = input['code']['coding'][0]['system']
-    code: str = input['code']['coding'][0]['code']
-    display: str = input['code']['coding'][0]['display']
+    system: str = intern_value(input['code']['coding'][0]['system'])
+    code: str = intern_value(input['code']['coding'][0]['code'])
+    display: str = intern_value(input['code']['coding'][0]['display'])
     value: Optional[Union[str, float]] = None
     unit: Optional[str] = None
 
     if 'valueQuantity' in input:
         value = input['valueQuantity']['value']
-        unit = input['valueQuantity']['unit']
+        unit = intern_value(input['valueQuantity']['unit'])
 
     return ObservationComponent(system, code, display, value, unit)
 
 
-def str_to_observation(input: str) -> Observation:
-    input = json.loads(input)
-
-    if not input['resourceType'] == 'Observation':
-        raise AssertionError('Not an observation resource type')
-
-    uuid: str = input['id']
-    status: str = input['status']
-    type: str = input['category'][0]['coding'][0]['code']
-    patient_uuid: str = input['subject']['reference'].split('/')[1]
-    encounter_uuid: str = input['encounter']['reference'].split('/')[1]
-    effective_datetime: datetime.datetime = dateutil.parser.isoparse(input['effectiveDateTime'])
-    issued_datetime: datetime.datetime = dateutil.parser.isoparse(input['issued'])
-
+def json_to_observation_components(input: dict) -> List[ObservationComponent]:
     components: List[ObservationComponent] = []
     if 'code' in input:
         components.append(json_to_observation_component(input))
@@ -114,22 +329,249 @@ def str_to_observation(input: str) -> Observation:
     if 'component' in input:
         for c in input['component']:
             components.append(json_to_observation_component(c))
+    return components
+
+
+_OBSERVATION_FIELDS: Dict[str, Callable[[dict], Any]] = {
+    'uuid': lambda input: input['id'],
+    'type': lambda input: intern_value(input['category'][0]['coding'][0]['code']),
+    'status': lambda input: intern_value(input['status']),
+    'patient_uuid': lambda input: input['subject']['reference'].split('/')[1],
+    'encounter_uuid': lambda input: input['encounter']['reference'].split('/')[1],
+    'effective_datetime': lambda input: parse_datetime(input['effectiveDateTime']),
+    'issued_datetime': lambda input: parse_datetime(input['issued']),
+    'components': json_to_observation_components,
+}
+
+
+# The top level keys the fields of an observation need, code and component are optional
+_OBSERVATION_KEYS: List[str] = ['id', 'category', 'status', 'subject', 'encounter', 'effectiveDateTime', 'issued']
+
+
+class LazyObservation(Observation):
+    """An observation wrapping the raw resource dict, each field is only decoded the first time it is read so parse
+    time and memory scale with the fields used. Corrupt fields raise when read rather than when parsed, unless parsed
+    with check (as parsers skipping errors do) which raises a KeyError for a missing field up front."""
+    def __init__(self, resource: dict):
+        self.resource: dict = resource
+
+
+for _name, _decoder in _OBSERVATION_FIELDS.items():
+    setattr(LazyObservation, _name, _lazy_field(_name, _decoder))
+
+
+def str_to_observation(input: Union[str, bytes], lazy: bool = False) -> Observation:
+    return dict_to_observation(loads(input), lazy=lazy)
+
+
+def dict_to_observation(input: dict, lazy: bool = False, check: bool = False) -> Observation:
+    if not input['resourceType'] == 'Observation':
+        raise AssertionError('Not an observation resource type')
+
+    if lazy:
+        if check:
+            _check_keys(input, _OBSERVATION_KEYS)
+        return LazyObservation(input)
+    return Observation(**{name: decoder(input) for name, decoder in _OBSERVATION_FIELDS.items()})
+
+
+def str_to_observations(input: Union[str, bytes], ignore_errors: bool = False,
+                        lazy: bool = False) -> List[Observation]:
+    return list(iter_bundle_observations(loads(input), ignore_errors=ignore_errors, lazy=lazy))
+
+
+def iter_bundle_observations(input: List[dict], ignore_errors: bool = False,
+                             lazy: bool = False) -> Iterator[Observation]:
+    for i in input:
+        for p in i.get('entry', []):
+            try:
+                observation = dict_to_observation(p['resource'], lazy=lazy, check=ignore_errors)
+            except Exception as e:
+                if ignore_errors:
+                    continue
+                else:
+                    raise e
+            yield observation
 
-    return Observation(uuid, type, status, patient_uuid, encounter_uuid, effective_datetime, issued_datetime, components)
 
+def iter_bundle_patient_observations(input: List[dict], ignore_errors: bool = False,
+                                     lazy: bool = False) -> Iterator[Tuple[Patient, List[Observation]]]:
+    """ Parses bundles holding both patients and their observations, as returned by a _revinclude=Observation:subject
+    search or Patient/$everything. Other resource types are skipped.
+    Args:
+        input: Bundle list
+        ignore_errors: Skip resources that fail to parse
+        lazy: Only decode each field the first time it is read
 
-def str_to_observations(input: str, ignore_errors: bool = False) -> List[Observation]:
-    input = json.loads(input)
+    Returns: An iterator of each patient with the observations in the bundles for that patient, in patient order
 
-    observations: List[Observation] = []
+    """
+    patients: List[Patient] = []
+    observations: Dict[str, List[Observation]] = {}
     for i in input:
-        if 'entry' in i:
-            for p in i['entry']:
-                try:
-                    observations.append(str_to_observation(json.dumps(p['resource'])))
-                except Exception as e:
-                    if ignore_errors:
-                        pass
-                    else:
-                        raise e
-    return observations
\ No newline at end of file
+        for p in i.get('entry', []):
+            try:
+                if p['resource']['resourceType'] == 'Patient':
+                    patients.append(dict_to_patient(p['resource'], lazy=lazy, check=ignore_errors))
+                elif p['resource']['resourceType'] == 'Observation':
+                    observation = dict_to_observation(p['resource'], lazy=lazy, check=ignore_errors)
+                    observations.setdefault(observation.patient_uuid, []).append(observation)
+            except Exception as e:
+                if ignore_errors:
+                    continue
+                else:
+                    raise e
+    for patient in patients:
+        yield patient, observations.get(patient.uuid, [])
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+
+
+class _StreamBuffer:
+    """A window over a stream of JSON bytes, only holding the text that has not been consumed yet"""
+    def __init__(self, input: Iterable[bytes]):
+        self.chunks: Iterator[bytes] = iter(input)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer: str = ''
+        self.position: int = 0
+        self.eof: bool = False
+
+    def fill(self, minimum: int = 1) -> bool:
+        self.buffer = self.buffer[self.position:]
+        self.position = 0
+        texts: List[str] = [self.buffer]
+        added: int = 0
+        for chunk in self.chunks:
+            texts.append(self.decoder.decode(chunk))
+            added += len(texts[-1])
+            if added >= minimum:
+                self.buffer = ''.join(texts)
+                return True
+        texts.append(self.decoder.decode(b'', final=True))
+        self.buffer = ''.join(texts)
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON stream')
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if character not in characters:
+            raise ValueError('Expected one of {} at position {} of JSON stream'.format(characters, self.position))
+        self.position += 1
+        return character
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buffer, self.position)
+                # A value ending exactly at the end of the buffer could be a truncated number
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Grow geometrically so a value spanning many small chunks is not re-decoded once per chunk
+            self.fill(len(self.buffer) - self.position)
+
+
+def _stream_entries(stream: _StreamBuffer) -> Iterator[dict]:
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.position += 1
+        return
+    while True:
+        stream.expect('{')
+        if stream.peek() == '}':
+            stream.position += 1
+        else:
+            while True:
+                key = stream.value()
+                stream.expect(':')
+                value = stream.value()
+                if key == 'resource':
+                    yield value
+                if stream.expect(',}') == '}':
+                    break
+        if stream.expect(',]') == ']':
+            return
+
+
+def _stream_object(stream: _StreamBuffer) -> Iterator[dict]:
+    stream.expect('{')
+    fields: dict = {}
+    streamed: bool = False
+    if stream.peek() == '}':
+        stream.position += 1
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'entry' and fields.get('resourceType', 'Bundle') == 'Bundle' and stream.peek() == '[':
+            yield from _stream_entries(stream)
+            streamed = True
+        else:
+            fields[key] = stream.value()
+        if stream.expect(',}') == '}':
+            break
+    # Anything that is not a bundle (a single resource or an OperationOutcome) is passed through whole
+    if not streamed and fields.get('resourceType') != 'Bundle':
+        yield fields
+
+
+def iter_stream_resources(input: Iterable[bytes]) -> Iterator[dict]:
+    """ Incrementally parses a JSON byte stream of a bundle or list of bundles, yielding each entry resource as soon
+    as it is complete so the whole response is never held in memory at once
+    Args:
+        input: Iterable of UTF-8 encoded byte chunks, for example response.iter_content()
+
+    Returns: An iterator of resource dicts
+
+    """
+    stream = _StreamBuffer(input)
+    if stream.peek() != '[':
+        yield from _stream_object(stream)
+        return
+    stream.position += 1
+    if stream.peek() == ']':
+        return
+    while True:
+        yield from _stream_object(stream)
+        if stream.expect(',]') == ']':
+            return
+
+
+def iter_stream_patients(input: Iterable[bytes], ignore_errors: bool = False,
+                         lazy: bool = False) -> Iterator[Patient]:
+    for resource in iter_stream_resources(input):
+        try:
+            patient = dict_to_patient(resource, lazy=lazy, check=ignore_errors)
+        except Exception as e:
+            if ignore_errors:
+                continue
+            else:
+                raise e
+        yield patient
+
+
+def iter_stream_observations(input: Iterable[bytes], ignore_errors: bool = False,
+                             lazy: bool = False) -> Iterator[Observation]:
+    for resource in iter_stream_resources(input):
+        try:
+            observation = dict_to_observation(resource, lazy=lazy, check=ignore_errors)
+        except Exception as e:
+            if ignore_errors:
+                continue
+            else:
+                raise e
+        yield observation
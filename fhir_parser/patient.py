@@ -10,6 +10,8 @@ from typing import List, Union, Optional, Dict, Tuple
 
 class Extension:
     """An extension consisting of a url and a value"""
+    __slots__ = ('url', 'value')
+
     def __init__(self, url: str, value: Union[str, float]):
         self.url: str = url
         self.value: Union[str, float] = value
@@ -17,13 +19,15 @@ class Extension:
     def __eq__(self, o: object) -> bool:
         if type(o) != Extension:
             return False
-        return self.__dict__ == o.__dict__
+        return all(getattr(self, slot) == getattr(o, slot) for slot in self.__slots__)
 
     def __str__(self) -> str:
         return self.url + ': ' + str(self.value)
 
 class Identifier:
     """An identifier consiting of a system, code, display, and value"""
+    __slots__ = ('system', 'code', 'display', 'value')
+
     def __init__(self, system: str, code: str, display: str, value: str):
         self.system: str = system
         self.code: str = code
@@ -33,7 +37,7 @@ class Identifier:
     def __eq__(self, o: object) -> bool:
         if type(o) != Identifier:
             return False
-        return self.__dict__ == o.__dict__
+        return all(getattr(self, slot) == getattr(o, slot) for slot in self.__slots__)
 
     def __str__(self) -> str:
         return self.display + ' ' + self.value
@@ -41,6 +45,8 @@ class Identifier:
 
 class Name:
     """The name consisting of family, given (can be multiple), and prefix (can be multiple)"""
+    __slots__ = ('family', 'given_list', 'prefix_list')
+
     def __init__(self, family: str, given: List[str], prefix: List[str]):
         self.family: str = family
         self.given_list: List[str] = given
@@ -83,6 +89,8 @@ class Name:
 
 class Telecom:
     """The telecommunication method consisting of the system, phone number, and use (for example home/work)"""
+    __slots__ = ('system', 'number', 'use')
+
     def __init__(self, system: str, number: str, use: str):
         self.system: str = system
         self.number: str = number
@@ -95,6 +103,8 @@ class Telecom:
 class Address:
     """The address consisting of multiple lines, city, state, postal code, country, and if applicable an extension
     containing the latitude and longitude"""
+    __slots__ = ('lines', 'city', 'state', 'postal_code', 'country', 'extensions')
+
     def __init__(self, lines: List[str], city: str, state: str, postal_code: str, country: str,
                  extensions: List[Extension]):
         self.lines: List[str] = lines
@@ -141,6 +151,8 @@ class Address:
 
 class MaritalStatus:
     """The marital status, stored as a 1 length string, str() can be used to get the full definition"""
+    __slots__ = ('marital_status',)
+
     def __init__(self, martial_status: str):
         self.marital_status: str = martial_status
 
@@ -162,6 +174,8 @@ class MaritalStatus:
 
 class Communications:
     """The known languages and communication methods"""
+    __slots__ = ('communication',)
+
     def __init__(self, communication: List[Tuple[str, str]]):
         self.communication = communication
 
@@ -187,6 +201,9 @@ class Communications:
 
 class Patient:
     """The patient object consisting of a uuid, name, telecoms, gender, birth_date, addresses, marial_status, multiple_birth, communications, extensions, and identifiers"""
+    __slots__ = ('uuid', 'name', 'telecoms', 'gender', 'birth_date', 'addresses', 'marital_status', 'multiple_birth',
+                 'communications', 'extensions', 'identifiers')
+
     def __init__(self, uuid: str, name: Name, telecoms: List[Telecom], gender: str, birth_date: datetime.date,
                  addresses: List[Address], marital_status: MaritalStatus, multiple_birth: bool,
                  communications: Communications, extensions: List[Extension], identifiers: List[Identifier]):
@@ -0,0 +1,241 @@
+"""
+Snapshot
+========
+Local columnar snapshots of parsed patients and observations as Arrow IPC streams, reopened memory mapped so jobs can
+start from a local file instead of the server, requires pyarrow. The stream format is used as each batch carries its
+own string dictionaries, which the Arrow file format does not allow.
+"""
+
+import datetime
+import os
+from typing import Iterable, Iterator, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from fhir_parser.frame import Categorical, ObservationFrame, PatientFrame
+from fhir_parser.observation import Observation, ObservationComponent
+from fhir_parser.patient import Patient, Name, Telecom, Address, Extension, MaritalStatus, Communications, Identifier
+
+PATIENTS_FILE: str = 'patients.arrow'
+OBSERVATIONS_FILE: str = 'observations.arrow'
+BATCH_SIZE: int = 65536
+
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+_EXTENSION = pa.struct([('url', pa.string()), ('value_string', pa.string()), ('value_decimal', pa.float64())])
+
+PATIENT_SCHEMA = pa.schema([
+    ('uuid', pa.string()),
+    ('family', pa.string()),
+    ('given', pa.list_(pa.string())),
+    ('prefix', pa.list_(pa.string())),
+    ('telecoms', pa.list_(pa.struct([('system', pa.string()), ('number', pa.string()), ('use', pa.string())]))),
+    ('gender', _CATEGORY),
+    ('birth_date', pa.date32()),
+    ('addresses', pa.list_(pa.struct([('lines', pa.list_(pa.string())), ('city', pa.string()),
+                                      ('state', pa.string()), ('postal_code', pa.string()),
+                                      ('country', pa.string()), ('extensions', pa.list_(_EXTENSION))]))),
+    ('marital_status', _CATEGORY),
+    ('multiple_birth', pa.bool_()),
+    ('communication', pa.list_(pa.struct([('code', pa.string()), ('display', pa.string())]))),
+    ('extensions', pa.list_(_EXTENSION)),
+    ('identifiers', pa.list_(pa.struct([('system', pa.string()), ('code', pa.string()), ('display', pa.string()),
+                                        ('value', pa.string())]))),
+    ('latitude', pa.float64()),
+    ('longitude', pa.float64()),
+])
+
+# One row per observation component, an observation without components has a single row with a null code
+OBSERVATION_SCHEMA = pa.schema([
+    ('uuid', _CATEGORY),
+    ('type', _CATEGORY),
+    ('status', _CATEGORY),
+    ('patient_uuid', _CATEGORY),
+    ('encounter_uuid', _CATEGORY),
+    ('effective', pa.timestamp('us', tz='UTC')),
+    ('effective_offset', pa.int32()),
+    ('issued', pa.timestamp('us', tz='UTC')),
+    ('issued_offset', pa.int32()),
+    ('system', _CATEGORY),
+    ('code', _CATEGORY),
+    ('display', _CATEGORY),
+    ('value', pa.float64()),
+    ('unit', _CATEGORY),
+])
+
+
+def _extension_row(extension: Extension) -> dict:
+    if isinstance(extension.value, str):
+        return {'url': extension.url, 'value_string': extension.value, 'value_decimal': None}
+    return {'url': extension.url, 'value_string': None, 'value_decimal': extension.value}
+
+
+def _row_extension(row: dict) -> Extension:
+    return Extension(row['url'], row['value_decimal'] if row['value_decimal'] is not None else row['value_string'])
+
+
+def _offset(value: datetime.datetime) -> Optional[int]:
+    return int(value.utcoffset().total_seconds()) if value.tzinfo is not None else None
+
+
+def _restore(value: datetime.datetime, offset: Optional[int]) -> datetime.datetime:
+    if offset is None:
+        return value.replace(tzinfo=None)
+    return value.astimezone(datetime.timezone(datetime.timedelta(seconds=offset)))
+
+
+def patient_to_row(patient: Patient) -> dict:
+    located = [a for a in patient.addresses if a.latitude is not None and a.longitude is not None]
+    return {
+        'uuid': patient.uuid,
+        'family': patient.name.family,
+        'given': list(patient.name.given_list),
+        'prefix': list(patient.name.prefix_list),
+        'telecoms': [{'system': t.system, 'number': t.number, 'use': t.use} for t in patient.telecoms],
+        'gender': patient.gender,
+        'birth_date': patient.birth_date,
+        'addresses': [{'lines': list(a.lines), 'city': a.city, 'state': a.state, 'postal_code': a.postal_code,
+                       'country': a.country, 'extensions': [_extension_row(e) for e in a.extensions]}
+                      for a in patient.addresses],
+        'marital_status': patient.marital_status.marital_status,
+        'multiple_birth': bool(patient.multiple_birth),
+        'communication': [{'code': c[0], 'display': c[1]} for c in patient.communications.communication],
+        'extensions': [_extension_row(e) for e in patient.extensions],
+        'identifiers': [{'system': i.system, 'code': i.code, 'display': i.display, 'value': i.value}
+                        for i in patient.identifiers],
+        'latitude': located[0].latitude if located else None,
+        'longitude': located[0].longitude if located else None,
+    }
+
+
+def row_to_patient(row: dict) -> Patient:
+    # The parser gives a patient without a prefix an empty string rather than an empty list
+    return Patient(row['uuid'], Name(row['family'], row['given'], row['prefix'] or ''),
+                   [Telecom(t['system'], t['number'], t['use']) for t in row['telecoms']], row['gender'],
+                   row['birth_date'],
+                   [Address(a['lines'], a['city'], a['state'], a['postal_code'], a['country'],
+                            [_row_extension(e) for e in a['extensions']]) for a in row['addresses']],
+                   MaritalStatus(row['marital_status']), row['multiple_birth'],
+                   Communications([(c['code'], c['display']) for c in row['communication']]),
+                   [_row_extension(e) for e in row['extensions']],
+                   [Identifier(i['system'], i['code'], i['display'], i['value']) for i in row['identifiers']])
+
+
+def observation_to_rows(observation: Observation) -> List[dict]:
+    row = {'uuid': observation.uuid, 'type': observation.type, 'status': observation.status,
+           'patient_uuid': observation.patient_uuid, 'encounter_uuid': observation.encounter_uuid,
+           'effective': observation.effective_datetime, 'effective_offset': _offset(observation.effective_datetime),
+           'issued': observation.issued_datetime, 'issued_offset': _offset(observation.issued_datetime),
+           'system': None, 'code': None, 'display': None, 'value': None, 'unit': None}
+    if not observation.components:
+        return [row]
+    return [dict(row, system=c.system, code=c.code, display=c.display,
+                 value=c.value if isinstance(c.value, (int, float)) else None, unit=c.unit)
+            for c in observation.components]
+
+
+def _categorical(column: pa.ChunkedArray) -> Categorical:
+    # Reuses the dictionary encoding written to the file, null entries become an extra None category
+    array = column.unify_dictionaries().combine_chunks()
+    categories = np.empty(len(array.dictionary) + 1, dtype=object)
+    categories[:] = array.dictionary.to_pylist() + [None]
+    codes = array.indices.fill_null(len(array.dictionary)).to_numpy(zero_copy_only=False).astype(np.int32)
+    return Categorical(codes, categories)
+
+
+def _write(path: str, schema: pa.Schema, rows: Iterable[dict]):
+    with pa.OSFile(path, 'wb') as sink, pa.ipc.new_stream(sink, schema) as writer:
+        batch: List[dict] = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+
+
+def write_snapshot(directory: str, patients: Iterable[Patient] = (), observations: Iterable[Observation] = ()):
+    """ Writes patients and observations to Arrow IPC files in a directory, streaming them in batches
+    Args:
+        directory: Snapshot directory, created if missing
+        patients: Patients to write
+        observations: Observations to write
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    _write(os.path.join(directory, PATIENTS_FILE), PATIENT_SCHEMA, map(patient_to_row, patients))
+    _write(os.path.join(directory, OBSERVATIONS_FILE), OBSERVATION_SCHEMA,
+           (row for observation in observations for row in observation_to_rows(observation)))
+
+
+class Snapshot:
+    """A snapshot directory reopened with memory mapping, the tables are read without copying so opening is near
+    instant and only the pages used are loaded"""
+    def __init__(self, directory: str):
+        self.directory: str = directory
+        self.patient_table: pa.Table = self._open(PATIENTS_FILE, PATIENT_SCHEMA)
+        self.observation_table: pa.Table = self._open(OBSERVATIONS_FILE, OBSERVATION_SCHEMA)
+
+    def _open(self, name: str, schema: pa.Schema) -> pa.Table:
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return schema.empty_table()
+        return pa.ipc.open_stream(pa.memory_map(path, 'r')).read_all()
+
+    def patients(self) -> Iterator[Patient]:
+        """
+        Returns: An iterator of the patients rebuilt a batch at a time
+
+        """
+        for batch in self.patient_table.to_batches():
+            yield from map(row_to_patient, batch.to_pylist())
+
+    def observations(self) -> Iterator[Observation]:
+        """
+        Returns: An iterator of the observations rebuilt a batch at a time, an observation split across batches is
+        rebuilt whole
+
+        """
+        current: Optional[Observation] = None
+        for batch in self.observation_table.to_batches():
+            for row in batch.to_pylist():
+                if current is None or current.uuid != row['uuid']:
+                    if current is not None:
+                        yield current
+                    current = Observation(row['uuid'], row['type'], row['status'], row['patient_uuid'],
+                                          row['encounter_uuid'], _restore(row['effective'], row['effective_offset']),
+                                          _restore(row['issued'], row['issued_offset']), [])
+                if row['code'] is not None:
+                    current.components.append(ObservationComponent(row['system'], row['code'], row['display'],
+                                                                   row['value'], row['unit']))
+        if current is not None:
+            yield current
+
+    def observation_frame(self) -> ObservationFrame:
+        """ Builds the frame straight from the columns without rebuilding any observations
+        Returns: The observation frame, matching ObservationFrame.from_observations(self.observations())
+
+        """
+        table = self.observation_table.filter(pc.is_valid(self.observation_table['code']))
+        return ObservationFrame(*[_categorical(table[name]) for name in ObservationFrame.CATEGORICAL],
+                                table['value'].to_numpy().astype(np.float64),
+                                table['effective'].to_numpy().astype('datetime64[us]'))
+
+    def patient_frame(self) -> PatientFrame:
+        """ Builds the frame straight from the columns without rebuilding any patients
+        Returns: The patient frame, matching PatientFrame.from_patients(self.patients())
+
+        """
+        table = self.patient_table
+        communication = table['communication'].combine_chunks()
+        offsets = communication.offsets.to_numpy().astype(np.int64)
+        uuid = np.empty(len(table), dtype=object)
+        uuid[:] = table['uuid'].to_pylist()
+        return PatientFrame(uuid, table['birth_date'].to_numpy().astype('datetime64[D]'),
+                            _categorical(table['gender']), _categorical(table['marital_status']),
+                            Categorical.from_values(communication.flatten().field('display').to_pylist()),
+                            offsets - offsets[0],
+                            table['latitude'].to_numpy().astype(np.float64),
+                            table['longitude'].to_numpy().astype(np.float64))
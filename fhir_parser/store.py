@@ -0,0 +1,240 @@
+"""
+Store
+=====
+An in memory store of parsed patients and observations with hash indexes for constant time lookups and joins
+"""
+
+import bisect
+import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fhir_parser.observation import Observation
+from fhir_parser.patient import Patient
+
+
+def _timestamp(value: datetime.datetime) -> float:
+    # Naive datetimes are taken to be UTC so they can be ordered alongside aware ones
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+
+class Store:
+    """Holds patients and observations by UUID, adding a resource with a UUID already held replaces it. Patients are
+    indexed by identifier code and value, observations by patient, encounter and component code, and by effective
+    time for range queries"""
+    def __init__(self):
+        self.patients: Dict[str, Patient] = {}
+        self.observations: Dict[str, Observation] = {}
+        self._identifiers: Dict[Tuple[str, str], Dict[str, None]] = {}
+        self._identifier_values: Dict[str, Dict[str, None]] = {}
+        self._by_patient: Dict[str, Dict[str, None]] = {}
+        self._by_encounter: Dict[str, Dict[str, None]] = {}
+        self._by_code: Dict[str, Dict[str, None]] = {}
+        # (effective timestamp, UUID) of every observation, kept sorted as observations are added and removed
+        self._effective: List[Tuple[float, str]] = []
+
+    @staticmethod
+    def _index(index: Dict, key, uuid: str):
+        index.setdefault(key, {})[uuid] = None
+
+    @staticmethod
+    def _unindex(index: Dict, key, uuid: str):
+        uuids = index.get(key)
+        if uuids is not None:
+            uuids.pop(uuid, None)
+            if not uuids:
+                del index[key]
+
+    def add_patient(self, patient: Patient):
+        """ Adds a patient, replacing any patient with the same UUID
+        Args:
+            patient: Patient to add
+
+        """
+        self.remove_patient(patient.uuid)
+        self.patients[patient.uuid] = patient
+        for identifier in patient.identifiers:
+            self._index(self._identifiers, (identifier.code, identifier.value), patient.uuid)
+            self._index(self._identifier_values, identifier.value, patient.uuid)
+
+    def add_patients(self, patients: Iterable[Patient]):
+        """
+        Args:
+            patients: Patients to add
+
+        """
+        for patient in patients:
+            self.add_patient(patient)
+
+    def remove_patient(self, uuid: str) -> Optional[Patient]:
+        """
+        Args:
+            uuid: Patient UUID
+
+        Returns: The patient removed or None if not held
+
+        """
+        patient = self.patients.pop(uuid, None)
+        if patient is not None:
+            for identifier in patient.identifiers:
+                self._unindex(self._identifiers, (identifier.code, identifier.value), uuid)
+                self._unindex(self._identifier_values, identifier.value, uuid)
+        return patient
+
+    def _add_observation(self, observation: Observation) -> Tuple[float, str]:
+        self.remove_observation(observation.uuid)
+        self.observations[observation.uuid] = observation
+        self._index(self._by_patient, observation.patient_uuid, observation.uuid)
+        self._index(self._by_encounter, observation.encounter_uuid, observation.uuid)
+        for component in observation.components:
+            self._index(self._by_code, component.code, observation.uuid)
+        return _timestamp(observation.effective_datetime), observation.uuid
+
+    def add_observation(self, observation: Observation):
+        """ Adds an observation, replacing any observation with the same UUID
+        Args:
+            observation: Observation to add
+
+        """
+        bisect.insort(self._effective, self._add_observation(observation))
+
+    def add_observations(self, observations: Iterable[Observation]):
+        """ Adds observations, their effective times are sorted and merged into the index in one pass rather than
+        inserted one at a time
+        Args:
+            observations: Observations to add
+
+        """
+        added: Dict[str, Tuple[float, str]] = {}
+        for observation in observations:
+            added[observation.uuid] = self._add_observation(observation)
+        if added:
+            # Sorting the two sorted runs merges them in linear time
+            self._effective.extend(sorted(added.values()))
+            self._effective.sort()
+
+    def remove_observation(self, uuid: str) -> Optional[Observation]:
+        """
+        Args:
+            uuid: Observation UUID
+
+        Returns: The observation removed or None if not held
+
+        """
+        observation = self.observations.pop(uuid, None)
+        if observation is not None:
+            self._unindex(self._by_patient, observation.patient_uuid, uuid)
+            self._unindex(self._by_encounter, observation.encounter_uuid, uuid)
+            for component in observation.components:
+                self._unindex(self._by_code, component.code, uuid)
+            self._unindex_effective(observation)
+        return observation
+
+    def _unindex_effective(self, observation: Observation):
+        key = (_timestamp(observation.effective_datetime), observation.uuid)
+        index = bisect.bisect_left(self._effective, key)
+        if index < len(self._effective) and self._effective[index] == key:
+            del self._effective[index]
+            return
+        # The effective time was changed after the observation was added, or it is not in the index yet
+        for index, entry in enumerate(self._effective):
+            if entry[1] == observation.uuid:
+                del self._effective[index]
+                return
+
+    def patient(self, uuid: str) -> Optional[Patient]:
+        """
+        Args:
+            uuid: Patient UUID
+
+        Returns: The patient or None if not held
+
+        """
+        return self.patients.get(uuid)
+
+    def observation(self, uuid: str) -> Optional[Observation]:
+        """
+        Args:
+            uuid: Observation UUID
+
+        Returns: The observation or None if not held
+
+        """
+        return self.observations.get(uuid)
+
+    def find_patients(self, value: str, code: Optional[str] = None) -> List[Patient]:
+        """ Finds patients by identifier, for example find_patients('999-58-8677', 'SS')
+        Args:
+            value: Identifier value
+            code: Identifier code (MR, SS, DL, PPN...), any code if None
+
+        Returns: The patients with a matching identifier
+
+        """
+        uuids = self._identifier_values.get(value, {}) if code is None else self._identifiers.get((code, value), {})
+        return [self.patients[uuid] for uuid in uuids]
+
+    def find_patient(self, value: str, code: Optional[str] = None) -> Optional[Patient]:
+        """
+        Args:
+            value: Identifier value
+            code: Identifier code (MR, SS, DL, PPN...), any code if None
+
+        Returns: The first patient with a matching identifier or None if there is none
+
+        """
+        patients = self.find_patients(value, code)
+        return patients[0] if patients else None
+
+    def patient_observations(self, uuid: str) -> List[Observation]:
+        """
+        Args:
+            uuid: Patient UUID
+
+        Returns: The observations for the patient
+
+        """
+        return [self.observations[o] for o in self._by_patient.get(uuid, {})]
+
+    def encounter_observations(self, uuid: str) -> List[Observation]:
+        """
+        Args:
+            uuid: Encounter UUID
+
+        Returns: The observations made during the encounter
+
+        """
+        return [self.observations[o] for o in self._by_encounter.get(uuid, {})]
+
+    def code_observations(self, code: str) -> List[Observation]:
+        """
+        Args:
+            code: Observation component code, for example a LOINC code
+
+        Returns: The observations with a component of the code
+
+        """
+        return [self.observations[o] for o in self._by_code.get(code, {})]
+
+    def observations_between(self, start: Optional[datetime.datetime] = None,
+                             end: Optional[datetime.datetime] = None) -> List[Observation]:
+        """ Finds observations by effective time with a binary search of the sorted index
+        Args:
+            start: Earliest effective time included, unbounded if None
+            end: Effective time before which observations are included, unbounded if None
+
+        Returns: The observations with an effective time in [start, end) in effective time order
+
+        """
+        # A one element tuple sorts before every entry with the same timestamp
+        low = bisect.bisect_left(self._effective, (_timestamp(start),)) if start is not None else 0
+        high = bisect.bisect_left(self._effective, (_timestamp(end),)) if end is not None else len(self._effective)
+        return [self.observations[uuid] for timestamp, uuid in self._effective[low:high]]
+
+    def joined(self) -> Dict[str, Tuple[Patient, List[Observation]]]:
+        """
+        Returns: Each patient by UUID with the observations for that patient
+
+        """
+        return {uuid: (patient, self.patient_observations(uuid)) for uuid, patient in self.patients.items()}
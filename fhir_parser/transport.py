@@ -0,0 +1,97 @@
+"""
+Transport
+=========
+Retry delays and client side rate limiting for keeping long running pulls within what the FHIR server can sustain
+"""
+
+import datetime
+import email.utils
+import random
+import threading
+import time
+from typing import Optional
+
+import requests
+
+# Responses worth retrying, the server is throttling, overloaded or briefly unavailable
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class StatusError(ConnectionError):
+    """An unsuccessful response, with the HTTP status code so transient failures can be told apart"""
+    def __init__(self, status: int):
+        super().__init__('Status code: {}'.format(status))
+        self.status: int = status
+
+
+def backoff_delay(attempt: int, backoff: float, max_backoff: float) -> float:
+    """ Full jitter exponential backoff, spreading retries from many workers out rather than retrying in lockstep
+    Args:
+        attempt: Number of attempts made so far, from 0
+        backoff: Delay ceiling in seconds for the first retry, doubled each attempt
+        max_backoff: Largest delay ceiling in seconds
+
+    Returns: A random delay in seconds between 0 and the ceiling for the attempt
+
+    """
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Args:
+        response: A 429 or 503 response, from requests or aiohttp
+
+    Returns: The seconds the server asked to wait in the Retry-After header, as a number or HTTP date, None if it
+    did not ask
+
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """Spaces requests evenly at no more than rate per second, shared by every thread using a client"""
+    def __init__(self, rate: float):
+        self.rate: float = rate
+        self._next: float = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Returns: Seconds to wait before sending the next request, which is counted as sent. Lets an event loop wait
+        with asyncio.sleep rather than blocking in acquire
+
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + 1.0 / self.rate
+        return max(0.0, wait)
+
+    def acquire(self):
+        """Waits until the next request may be sent"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """ Holds back every request for a number of seconds, for when the server asks to slow down
+        Args:
+            seconds: Seconds from now before the next request may be sent
+
+        """
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
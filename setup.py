@@ -14,7 +14,17 @@ setuptools.setup(
     url='https://github.com/greenfrogs/FHIR-Parser',
     license='Apache License 2.0',
     install_requires=['requests>=2.23.0', 'python-dateutil>=2.8.1'],
+    extras_require={
+        'async': ['aiohttp>=3.6.2'],
+        'frame': ['numpy>=1.18.1'],
+        'orjson': ['orjson>=3.0.0'],
+        'snapshot': ['numpy>=1.18.1', 'pyarrow>=7.0.0'],
+        'ujson': ['ujson>=1.35'],
+    },
     packages=setuptools.find_packages(),
+    entry_points={
+        'console_scripts': ['fhir-parse=fhir_parser.bulk:main'],
+    },
     classifiers=[
         'Programming Language :: Python :: 3',
         'Intended Audience :: Developers',
@@ -0,0 +1,156 @@
+"""
+Benchmarks for the FHIR parser, run from the repository root with ``python -m tests.benchmark``
+"""
+
+import datetime
+import json
+import os
+import random
+import tempfile
+import timeit
+import tracemalloc
+from typing import Callable, List
+
+import dateutil.parser
+
+from fhir_parser import parser
+from fhir_parser.bulk import parse_files
+from fhir_parser.observation import ObservationComponent
+from fhir_parser.parser import str_to_patient, str_to_patients, str_to_observation, str_to_observations, \
+    parse_datetime
+
+
+def load(name: str) -> str:
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), name), 'r') as file:
+        return file.read()
+
+
+def synthetic_bundle(name: str, copies: int) -> str:
+    """
+    Args:
+        name: Bundle fixture file name
+        copies: Number of times to repeat the bundle list
+
+    Returns: A large synthetic bundle list as a JSON string
+
+    """
+    return json.dumps(json.loads(load(name)) * copies)
+
+
+def round_trip_patients(input: str) -> List:
+    return [str_to_patient(json.dumps(p['resource'])) for i in json.loads(input) for p in i['entry']]
+
+
+def round_trip_observations(input: str) -> List:
+    return [str_to_observation(json.dumps(p['resource'])) for i in json.loads(input) if 'entry' in i
+            for p in i['entry']]
+
+
+def benchmark_bundle_parsing(copies: int = 200, repeat: int = 3):
+    patients = synthetic_bundle('test_patients.json', copies)
+    observations = synthetic_bundle('test_observations.json', copies)
+
+    for label, before, after, data in [('patients', round_trip_patients, str_to_patients, patients),
+                                       ('observations', round_trip_observations, str_to_observations, observations)]:
+        before_time = min(timeit.repeat(lambda: before(data), number=1, repeat=repeat))
+        after_time = min(timeit.repeat(lambda: after(data), number=1, repeat=repeat))
+        print('{:<14} {:>8} entries  round trip {:.3f}s  dict {:.3f}s  speedup {:.2f}x'.format(
+            label, len(after(data)), before_time, after_time, before_time / after_time))
+
+
+def benchmark_datetime_parsing(count: int = 1000000, distinct: int = 50000):
+    start = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=1)))
+    pool = [(start + datetime.timedelta(seconds=random.randrange(10 ** 9))).isoformat(timespec='milliseconds')
+            for _ in range(distinct)]
+    # Observations of an encounter share their effective and issued timestamps
+    timestamps = [random.choice(pool) for _ in range(count)]
+
+    before_time = timeit.timeit(lambda: [dateutil.parser.isoparse(t) for t in timestamps], number=1)
+    parse_datetime.cache_clear()
+    after_time = timeit.timeit(lambda: [parse_datetime(t) for t in timestamps], number=1)
+    print('{:<14} {:>8} stamps   isoparse   {:.3f}s  fast {:.3f}s  speedup {:.2f}x'.format(
+        'datetimes', count, before_time, after_time, before_time / after_time))
+
+
+class DictObservationComponent:
+    """ObservationComponent as it was before __slots__, storing its attributes in a per instance __dict__"""
+    def __init__(self, system, code, display, value, unit):
+        self.system = system
+        self.code = code
+        self.display = display
+        self.value = value
+        self.unit = unit
+
+
+def traced_size(build: Callable[[], list]) -> int:
+    tracemalloc.start()
+    objects = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def benchmark_component_memory(count: int = 1000000):
+    def build(cls):
+        return lambda: [cls('http://loinc.org', '8462-4', 'Diastolic Blood Pressure', float(i), 'mm[Hg]')
+                        for i in range(count)]
+
+    before_size = traced_size(build(DictObservationComponent))
+    after_size = traced_size(build(ObservationComponent))
+    print('{:<14} {:>8} objects  __dict__   {:.1f}MB  slots {:.1f}MB  saving {:.0%}'.format(
+        'components', count, before_size / 2 ** 20, after_size / 2 ** 20, 1 - after_size / before_size))
+
+
+def benchmark_intern_memory(copies: int = 100):
+    observations = synthetic_bundle('test_observations.json', copies)
+    before_size = 0
+    try:
+        parser.INTERN_POOL_SIZE = 0
+        parser.clear_intern_pool()
+        before_size = traced_size(lambda: str_to_observations(observations))
+    finally:
+        parser.INTERN_POOL_SIZE = 65536
+    parser.clear_intern_pool()
+    after_size = traced_size(lambda: str_to_observations(observations))
+    print('{:<14} {:>8} entries  no pool    {:.1f}MB  pool {:.1f}MB  saving {:.0%}'.format(
+        'interning', len(str_to_observations(observations)), before_size / 2 ** 20, after_size / 2 ** 20,
+        1 - after_size / before_size))
+
+
+def benchmark_json_backend(copies: int = 200, repeat: int = 3):
+    observations = synthetic_bundle('test_observations.json', copies).encode('utf-8')
+    selected = parser.JSON_BACKEND
+    try:
+        parser.set_json_backend('json')
+        before_time = min(timeit.repeat(lambda: str_to_observations(observations.decode('utf-8')), number=1,
+                                        repeat=repeat))
+        parser.set_json_backend(selected)
+        after_time = min(timeit.repeat(lambda: str_to_observations(observations), number=1, repeat=repeat))
+    finally:
+        parser.set_json_backend(selected)
+    print('{:<14} {:>8} entries  json text  {:.3f}s  {} bytes {:.3f}s  speedup {:.2f}x'.format(
+        'json backend', len(str_to_observations(observations)), before_time, selected, after_time,
+        before_time / after_time))
+
+
+def benchmark_bulk_parsing(files: int = 16, copies: int = 25):
+    processes = os.cpu_count() or 1
+    with tempfile.TemporaryDirectory() as directory:
+        for number in range(files):
+            with open(os.path.join(directory, '{}.json'.format(number)), 'w') as file:
+                file.write(synthetic_bundle('test_observations.json', copies))
+        before_time = min(timeit.repeat(lambda: parse_files(directory, processes=1), number=1, repeat=1))
+        after_time = min(timeit.repeat(lambda: parse_files(directory, processes=processes), number=1, repeat=1))
+        print('{:<14} {:>8} entries  1 process  {:.3f}s  {} processes {:.3f}s  speedup {:.2f}x'.format(
+            'bulk', len(parse_files(directory, processes=1)[1]), before_time, processes, after_time,
+            before_time / after_time))
+
+
+if __name__ == '__main__':
+    benchmark_bundle_parsing()
+    benchmark_datetime_parsing()
+    benchmark_component_memory()
+    benchmark_intern_memory()
+    benchmark_json_backend()
+    benchmark_bulk_parsing()
@@ -0,0 +1,164 @@
+import copy
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple, Union
+
+import pytest
+
+from fhir_parser.observation import Observation
+from fhir_parser.parser import str_to_observations, str_to_patients
+from fhir_parser.patient import Patient
+
+
+def load(name: str) -> str:
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), name), 'r') as file:
+        return file.read()
+
+
+class StubServer:
+    """A local FHIR server stub, routes map a request path to a (status, body, headers) response or a callable
+    taking the request handler and returning one"""
+    def __init__(self):
+        self.routes: Dict[str, Union[Tuple[int, Union[str, bytes], Dict[str, str]], Callable]] = {}
+        self.requests: List[Tuple[str, str, Dict[str, str], bytes]] = []
+        self.clients: List[Tuple[str, int]] = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,), daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        return 'http://127.0.0.1:{}/api/'.format(self.server.server_address[1])
+
+    def add_json(self, path: str, data, status: int = 200, headers: Dict[str, str] = None):
+        self.routes[path] = (status, json.dumps(data), headers or {})
+
+    def paths(self) -> List[str]:
+        return [r[1] for r in self.requests]
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length) if length else b''
+                stub.requests.append((self.command, self.path, dict(self.headers), body))
+                stub.clients.append(self.client_address)
+                path = self.path.split('?')[0]
+                route = stub.routes.get(self.path, stub.routes.get(path))
+                if callable(route):
+                    route = route(self, body)
+                status, data, headers = route if route is not None else (404, '', {})
+                data = data.encode('utf-8') if isinstance(data, str) else data
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                if 'Content-Type' not in headers:
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = respond
+            do_POST = respond
+            do_DELETE = respond
+
+        return Handler
+
+
+def slow_route(response: Tuple[int, Union[str, bytes], Dict[str, str]], delay: float) -> Callable:
+    """A route answering with response after delay seconds, route.peak is the most requests it handled at once"""
+    lock = threading.Lock()
+    active = [0]
+
+    def route(handler, body):
+        with lock:
+            active[0] += 1
+            route.peak = max(route.peak, active[0])
+        time.sleep(delay)
+        with lock:
+            active[0] -= 1
+        return response
+    route.peak = 0
+    return route
+
+
+@pytest.fixture
+def server():
+    stub = StubServer()
+    stub.thread.start()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+@pytest.fixture(scope='session')
+def patient_bundles() -> List[dict]:
+    return json.loads(load('test_patients.json'))
+
+
+@pytest.fixture(scope='session')
+def observation_bundles() -> List[dict]:
+    return json.loads(load('test_observations.json'))
+
+
+@pytest.fixture(scope='session')
+def patients() -> List[Patient]:
+    """The parsed test patients, shared so treat them as read only"""
+    return str_to_patients(load('test_patients.json'))
+
+
+@pytest.fixture(scope='session')
+def observations() -> List[Observation]:
+    """The parsed test observations, shared so treat them as read only"""
+    return str_to_observations(load('test_observations.json'))
+
+
+SUBSETTED = {'tag': [{'system': 'http://terminology.hl7.org/CodeSystem/v3-ObservationValue', 'code': 'SUBSETTED'}]}
+
+
+def project(resource: dict, elements: List[str]) -> dict:
+    """A resource as returned by an _elements search, with only the mandatory and requested elements and tagged
+    SUBSETTED"""
+    projected = {k: v for k, v in resource.items() if k in ['resourceType', 'id'] + elements}
+    projected['meta'] = SUBSETTED
+    return projected
+
+
+def split_pages(bundle: dict, size: int) -> List[dict]:
+    """Split a single bundle into pages of size entries, only the last page has no next link"""
+    pages = []
+    for start in range(0, len(bundle['entry']), size):
+        page = copy.deepcopy(bundle)
+        page['entry'] = bundle['entry'][start:start + size]
+        page['link'] = [link for link in page['link'] if link['relation'] != 'next']
+        if start + size < len(bundle['entry']):
+            page['link'].insert(0, {'relation': 'next', 'url': 'LINK/Patient?page=' + str(len(pages) + 2)})
+        pages.append(page)
+    return pages
+
+
+@pytest.fixture
+def patient_pages(server, patient_bundles):
+    pages = split_pages(patient_bundles[0], 5)
+    for number, page in enumerate(pages, 1):
+        server.add_json('/api/Patient/pages/' + str(number), [page])
+    server.add_json('/api/Patient/', [page for page in pages])
+    return pages
+
+
+@pytest.fixture
+def observation_pages(server, observation_bundles):
+    uuid = '8f789d0b-3145-4cf2-8504-13159edaa747'
+    for number in range(1, len(observation_bundles) + 1):
+        server.add_json('/api/Observation/pages/{}/{}'.format(number, uuid), observation_bundles[:number])
+    server.add_json('/api/Observation/' + uuid, observation_bundles)
+    return uuid
@@ -0,0 +1,119 @@
+import asyncio
+import copy
+import json
+import time
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from conftest import load, project, slow_route
+from fhir_parser import AsyncFHIR
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_async_patients(server, patient_pages):
+    async def fetch():
+        async with AsyncFHIR(server.endpoint) as fhir:
+            return (await fhir.get_all_patients(), await fhir.get_patient_page(1),
+                    [p async for p in fhir.iter_patients()])
+
+    patients, page, iterated = run(fetch())
+    assert len(patients) == 10
+    assert len(page) == 5
+    assert [p.uuid for p in iterated] == [p.uuid for p in patients]
+
+
+def test_async_observations(server, observation_pages):
+    async def fetch():
+        async with AsyncFHIR(server.endpoint) as fhir:
+            return (await fhir.get_patient_observations(observation_pages),
+                    [o async for o in fhir.iter_patient_observations(observation_pages, search={'_count': 10})])
+
+    observations, iterated = run(fetch())
+    assert len(observations) == 83
+    assert [o.uuid for o in iterated] == [o.uuid for o in observations]
+    assert server.paths()[-1] == '/api/Observation/pages/9/{}?_count=10'.format(observation_pages)
+
+
+def test_gather_patient_observations(server, observation_bundles):
+    slow = slow_route((200, json.dumps(observation_bundles[:1]), {}), 0.1)
+    ids = ['patient-' + str(i) for i in range(12)]
+    for id in ids:
+        server.routes['/api/Observation/' + id] = slow
+
+    async def fetch(ids, **kwargs):
+        async with AsyncFHIR(server.endpoint, max_concurrency=4, **kwargs) as fhir:
+            return await fhir.gather_patient_observations(ids)
+
+    results = run(fetch(ids[:6] + ['missing'] + ids[6:]))
+    assert list(results.keys()) == ids
+    assert all(len(observations) == 10 for observations in results.values())
+    assert 1 < slow.peak <= 4
+    with pytest.raises(ConnectionError):
+        run(fetch(['missing'] + ids[:2], ignore_errors=False))
+
+
+def test_async_error(server):
+    async def fetch():
+        async with AsyncFHIR(server.endpoint) as fhir:
+            await fhir.get_patient('missing')
+
+    with pytest.raises(ConnectionError):
+        run(fetch())
+
+
+def test_async_retries(server):
+    calls = []
+
+    def flaky(handler, body):
+        calls.append(time.monotonic())
+        responses = [(503, '', {'Retry-After': '0.3'}), (500, '', {}), (200, load('test_patient.json'), {})]
+        return responses[min(len(calls), len(responses)) - 1]
+    server.routes['/api/Patient/a'] = flaky
+    server.routes['/api/Patient/b'] = (500, '', {})
+
+    async def fetch(id, **kwargs):
+        async with AsyncFHIR(server.endpoint, backoff=0.01, **kwargs) as fhir:
+            return await fhir.get_patient(id)
+
+    assert run(fetch('a')).uuid == '8f789d0b-3145-4cf2-8504-13159edaa747'
+    assert len(calls) == 3
+    assert calls[1] - calls[0] >= 0.3
+    with pytest.raises(ConnectionError):
+        run(fetch('b', retries=2))
+    assert server.paths().count('/api/Patient/b') == 3
+    with pytest.raises(ConnectionError):
+        run(fetch('missing'))
+    assert server.paths().count('/api/Patient/missing') == 1
+
+
+def test_async_rate_limit(server):
+    server.routes['/api/Patient/a'] = (200, load('test_patient.json'), {})
+
+    async def fetch():
+        async with AsyncFHIR(server.endpoint, rate_limit=20) as fhir:
+            return await asyncio.gather(*[fhir.get_patient('a') for _ in range(6)])
+
+    start = time.monotonic()
+    assert len(run(fetch())) == 6
+    assert time.monotonic() - start >= 0.25
+
+
+def test_async_projection(server, observation_bundles):
+    projected = copy.deepcopy(observation_bundles)
+    for bundle in projected:
+        for entry in bundle['entry']:
+            entry['resource'] = project(entry['resource'], ['code'])
+    server.add_json('/api/Observation/patient-1?_elements=code', projected)
+
+    async def fetch():
+        async with AsyncFHIR(server.endpoint) as fhir:
+            return await fhir.get_patient_observations('patient-1', search={'_elements': 'code'})
+
+    observations = run(fetch())
+    assert [o.components[0].code for o in observations] == \
+        [e['resource']['code']['coding'][0]['code'] for b in observation_bundles for e in b['entry']]
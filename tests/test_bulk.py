@@ -0,0 +1,90 @@
+import gzip
+import json
+import os
+
+import pytest
+
+from fhir_parser import bulk
+from fhir_parser.bulk import find_files, parse_files, parse_files_to_frames
+
+
+@pytest.fixture
+def files(tmp_path, patient_bundles, observation_bundles):
+    # Bundle list JSON, gzip'd JSON and NDJSON of single resources split over several files
+    (tmp_path / 'observations.json').write_text(json.dumps(observation_bundles[:4]))
+    with gzip.open(str(tmp_path / 'observations.json.gz'), 'wt') as file:
+        json.dump(observation_bundles[4:], file)
+    (tmp_path / 'patients.ndjson').write_text(
+        '\n'.join(json.dumps(entry['resource']) for entry in patient_bundles[0]['entry']) + '\n')
+    (tmp_path / 'notes.txt').write_text('not a bundle')
+    return tmp_path
+
+
+def test_find_files(files):
+    assert [os.path.basename(f) for f in find_files(str(files))] == \
+        ['observations.json', 'observations.json.gz', 'patients.ndjson']
+    assert [os.path.basename(f) for f in find_files(str(files / '*.json*'))] == \
+        ['observations.json', 'observations.json.gz']
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_parse_files(files, processes, patient_bundles, observation_bundles):
+    # A small chunk size splits the NDJSON file into many shards
+    patients, observations = parse_files(str(files), processes=processes, chunk_size=1000)
+    assert [p.uuid for p in patients] == [e['resource']['id'] for e in patient_bundles[0]['entry']]
+    assert [o.uuid for o in observations] == [e['resource']['id'] for b in observation_bundles for e in b['entry']]
+
+
+def test_parse_errors(tmp_path):
+    (tmp_path / 'corrupt.ndjson').write_text('{"resourceType": "Patient"}\n{"resourceType": "Encounter"}\n')
+    assert parse_files(str(tmp_path), ignore_errors=True) == ([], [])
+    with pytest.raises(KeyError):
+        parse_files(str(tmp_path))
+
+
+def test_parse_errors_truncated(tmp_path, patient_bundles):
+    lines = [json.dumps(entry['resource']) for entry in patient_bundles[0]['entry']]
+    lines[2] = lines[2][:50]
+    (tmp_path / 'patients.ndjson').write_text('\n'.join(lines) + '\n')
+    (tmp_path / 'truncated.json').write_text(json.dumps(patient_bundles)[:100])
+    (tmp_path / 'entries.json').write_text(json.dumps({'resourceType': 'Bundle', 'entry': [{'search': {}}]}))
+    patients, observations = parse_files(str(tmp_path), processes=1, ignore_errors=True)
+    expected = [e['resource']['id'] for e in patient_bundles[0]['entry']]
+    assert [p.uuid for p in patients] == expected[:2] + expected[3:]
+    with pytest.raises(ValueError):
+        parse_files(str(tmp_path / 'patients.ndjson'), processes=1)
+    with pytest.raises(KeyError):
+        parse_files(str(tmp_path / 'entries.json'), processes=1)
+
+
+def test_parse_errors_to_frames(tmp_path, observation_bundles):
+    pytest.importorskip('numpy')
+    resources = [dict(e['resource']) for b in observation_bundles for e in b['entry']]
+    del resources[5]['effectiveDateTime']
+    (tmp_path / 'observations.ndjson').write_text('\n'.join(json.dumps(r) for r in resources) + '\n')
+    assert len(parse_files(str(tmp_path), ignore_errors=True)[1]) == 82
+    patient_frame, observation_frame = parse_files_to_frames(str(tmp_path), processes=1, ignore_errors=True)
+    assert len(set(observation_frame.uuid.values().tolist())) == 82
+    assert resources[5]['id'] not in observation_frame.uuid.values().tolist()
+    with pytest.raises(KeyError):
+        parse_files_to_frames(str(tmp_path), processes=1)
+
+
+def test_parse_files_to_frames(files):
+    np = pytest.importorskip('numpy')
+    from fhir_parser.frame import ObservationFrame, PatientFrame
+
+    patient_frame, observation_frame = parse_files_to_frames(str(files), processes=2, chunk_size=1000)
+    patients, observations = parse_files(str(files), processes=1)
+    expected = ObservationFrame.from_observations(observations)
+    assert observation_frame.code.values().tolist() == expected.code.values().tolist()
+    assert np.array_equal(observation_frame.value, expected.value, equal_nan=True)
+    expected = PatientFrame.from_patients(patients)
+    assert patient_frame.uuid.tolist() == expected.uuid.tolist()
+    assert np.array_equal(patient_frame.language_offsets, expected.language_offsets)
+    assert patient_frame.histogram('languages') == expected.histogram('languages')
+
+
+def test_main(files, capsys):
+    bulk.main([str(files), '--processes', '1'])
+    assert capsys.readouterr().out == '10 patients, 83 observations\n'
@@ -0,0 +1,123 @@
+import os
+import time
+
+import pytest
+
+from conftest import load
+from fhir_parser import FHIR
+from fhir_parser.cache import Cache, MemoryCache, DiskCache
+
+
+def test_memory_cache():
+    cache = MemoryCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache = MemoryCache(ttl=0.05)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_disk_cache(tmpdir):
+    path = os.path.join(str(tmpdir), 'cache.sqlite')
+    cache = DiskCache(path)
+    cache.set('Patient/a', '{"id": "a"}')
+    cache.close()
+
+    cache = DiskCache(path)
+    assert cache.get('Patient/a') == b'{"id": "a"}'
+    assert cache.get('Patient/b') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.clear()
+    assert len(cache) == 0
+    cache.close()
+
+    cache = DiskCache(path, ttl=0.05)
+    cache.set('Patient/a', '{"id": "a"}')
+    time.sleep(0.1)
+    assert cache.get('Patient/a') is None
+
+
+def test_fhir_cache(server, tmpdir):
+    server.routes['/api/Patient/8f789d0b-3145-4cf2-8504-13159edaa747'] = (200, load('test_patient.json'), {})
+    server.routes['/api/Observation/single/4a064229-2a40-45f4-a259-f4eedcfd525a'] = \
+        (200, load('test_observation.json'), {})
+    server.routes['/api/Patient/missing'] = (200, load('test_error.json'), {})
+
+    memory = MemoryCache()
+    fhir = FHIR(server.endpoint, cache=memory)
+    patient = fhir.get_patient('8f789d0b-3145-4cf2-8504-13159edaa747')
+    assert fhir.get_patient('8f789d0b-3145-4cf2-8504-13159edaa747') is patient
+    fhir.get_observation('4a064229-2a40-45f4-a259-f4eedcfd525a')
+    fhir.get_observation('4a064229-2a40-45f4-a259-f4eedcfd525a')
+    assert len(server.requests) == 2
+    assert (memory.hits, memory.misses) == (2, 2)
+
+    for _ in range(2):
+        try:
+            fhir.get_patient('missing')
+        except ConnectionError:
+            pass
+    assert len(server.requests) == 4
+
+    disk = DiskCache(os.path.join(str(tmpdir), 'cache.sqlite'))
+    FHIR(server.endpoint, cache=disk).get_patient('8f789d0b-3145-4cf2-8504-13159edaa747')
+    patient = FHIR(server.endpoint, cache=disk).get_patient('8f789d0b-3145-4cf2-8504-13159edaa747')
+    assert patient.uuid == '8f789d0b-3145-4cf2-8504-13159edaa747'
+    assert len(server.requests) == 5
+    assert (disk.hits, disk.misses) == (1, 1)
+
+
+def test_conditional_requests(server, tmpdir):
+    def patient(handler, body):
+        if handler.headers.get('If-None-Match') == '"v1"':
+            return 304, '', {'ETag': '"v1"'}
+        return 200, load('test_patient.json'), {'ETag': '"v1"', 'Last-Modified': 'Tue, 10 Mar 2020 12:00:00 GMT'}
+
+    server.routes['/api/Patient/8f789d0b-3145-4cf2-8504-13159edaa747'] = patient
+
+    for cache in [MemoryCache(ttl=0), DiskCache(os.path.join(str(tmpdir), 'cache.sqlite'), ttl=0)]:
+        fhir = FHIR(server.endpoint, cache=cache)
+        first = fhir.get_patient('8f789d0b-3145-4cf2-8504-13159edaa747')
+        time.sleep(0.01)
+        second = fhir.get_patient('8f789d0b-3145-4cf2-8504-13159edaa747')
+        assert second.uuid == first.uuid
+        assert cache.revalidations == 1
+        headers = server.requests[-1][2]
+        assert headers['If-None-Match'] == '"v1"'
+        assert headers['If-Modified-Since'] == 'Tue, 10 Mar 2020 12:00:00 GMT'
+    assert 'If-None-Match' not in server.requests[0][2]
+    assert len(server.requests) == 4
+
+
+def test_cache_copies(server, patient_pages):
+    fhir = FHIR(server.endpoint, cache=MemoryCache())
+    patients = fhir.get_all_patients()
+    patients.clear()
+    cached = fhir.get_all_patients()
+    assert len(cached) == 10
+    cached.pop()
+    assert len(fhir.get_all_patients()) == 10
+    assert fhir.get_all_patients()[0] is cached[0]
+    assert len(server.requests) == 1
+
+
+def test_abstract_cache():
+    class Partial(Cache):
+        def _load(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Cache()
+    with pytest.raises(TypeError):
+        Partial()
@@ -0,0 +1,332 @@
+import copy
+import datetime
+import itertools
+import json
+import time
+import urllib.parse
+
+import pytest
+
+import test_parser
+from conftest import load, project, slow_route, split_pages
+from fhir_parser import FHIR
+from fhir_parser.parser import LazyPatient, LazyObservation, parse_datetime
+from fhir_parser.store import Store
+from fhir_parser.transport import StatusError
+
+
+def test_iter_patients(server, patient_pages):
+    fhir = FHIR(server.endpoint)
+    patients = fhir.iter_patients()
+    assert next(patients).uuid == '8f789d0b-3145-4cf2-8504-13159edaa747'
+    assert server.paths() == ['/api/Patient/pages/1']
+
+    assert len(list(patients)) == 9
+    assert server.paths() == ['/api/Patient/pages/1', '/api/Patient/pages/2']
+    assert [p.uuid for p in fhir.iter_patients()] == [p.uuid for p in fhir.get_all_patients()]
+
+
+def test_iter_patient_observations(server, observation_pages):
+    fhir = FHIR(server.endpoint)
+    observations = list(fhir.iter_patient_observations(observation_pages))
+    assert len(observations) == 83
+    assert len(set(o.uuid for o in observations)) == 83
+    assert observations[78].uuid == '4a064229-2a40-45f4-a259-f4eedcfd525a'
+    assert server.paths() == ['/api/Observation/pages/{}/{}'.format(n, observation_pages) for n in range(1, 10)]
+
+    assert len(list(itertools.islice(fhir.iter_patient_observations(observation_pages), 15))) == 15
+    assert len(server.paths()) == 11
+
+
+def test_prefetch_pages(server, patient_pages, observation_pages):
+    fhir = FHIR(server.endpoint)
+    patients = fhir.iter_patients(prefetch=2)
+    assert next(patients).uuid == '8f789d0b-3145-4cf2-8504-13159edaa747'
+    # The second page is requested in the background before the first has been consumed
+    for _ in range(100):
+        if '/api/Patient/pages/2' in server.paths():
+            break
+        time.sleep(0.01)
+    assert '/api/Patient/pages/2' in server.paths()
+    assert len(list(patients)) == 9
+
+    observations = list(fhir.iter_patient_observations(observation_pages, prefetch=3))
+    assert [o.uuid for o in observations] == [o.uuid for o in fhir.iter_patient_observations(observation_pages)]
+
+
+def test_prefetch_pages_processes(server, observation_pages):
+    fhir = FHIR(server.endpoint)
+    observations = list(fhir.iter_patient_observations(observation_pages, prefetch=2, processes=2))
+    assert len(observations) == 83
+    test_parser.test_observation_parser(observations[78])
+
+
+def test_stream_all_patients(server, patient_pages):
+    fhir = FHIR(server.endpoint)
+    assert [p.uuid for p in fhir.stream_all_patients(chunk_size=512)] == [p.uuid for p in fhir.get_all_patients()]
+
+
+def test_stream_patient_observations(server, observation_pages):
+    fhir = FHIR(server.endpoint)
+    observations = list(fhir.stream_patient_observations(observation_pages, chunk_size=1024))
+    assert len(observations) == 83
+    assert observations[78].uuid == '4a064229-2a40-45f4-a259-f4eedcfd525a'
+
+
+def test_stream_error(server):
+    server.routes['/api/Patient/'] = (200, load('test_error.json'), {})
+    with pytest.raises(ConnectionError):
+        list(FHIR(server.endpoint).stream_all_patients())
+    server.routes['/api/Patient/'] = (404, '', {})
+    with pytest.raises(StatusError) as error:
+        list(FHIR(server.endpoint).stream_all_patients())
+    assert error.value.status == 404
+
+
+def test_session_keep_alive(server, patient_pages):
+    with FHIR(server.endpoint, pool_size=2) as fhir:
+        fhir.get_all_patients()
+        fhir.get_patient_page(1)
+        list(fhir.iter_patients())
+    assert len(server.requests) == 4
+    assert len(set(server.clients)) == 1
+
+
+def test_get_patients_observations(server, observation_bundles):
+    slow = slow_route((200, json.dumps(observation_bundles[:1]), {}), 0.05)
+    state = {'flaky': 0}
+
+    def flaky(handler, body):
+        state['flaky'] += 1
+        return (500, '', {}) if state['flaky'] == 1 else slow(handler, body)
+
+    ids = ['patient-' + str(i) for i in range(10)]
+    for id in ids:
+        server.routes['/api/Observation/' + id] = slow
+    server.routes['/api/Observation/patient-3'] = flaky
+
+    with FHIR(server.endpoint, pool_size=4) as fhir:
+        results = fhir.get_patients_observations(ids + ['missing'], max_workers=4)
+    assert list(results.keys()) == ids
+    assert all(len(observations) == 10 for observations in results.values())
+    assert 1 < slow.peak <= 4
+    assert state['flaky'] == 2
+    # A 404 is not transient so is only requested once
+    assert server.paths().count('/api/Observation/missing') == 1
+
+    with pytest.raises(ConnectionError):
+        FHIR(server.endpoint, ignore_errors=False).get_patients_observations(['patient-1', 'missing'])
+
+    # Each request is retried by the client alone, not once more per retry of the whole fetch
+    server.routes['/api/Observation/failing'] = (500, '', {})
+    with pytest.raises(ConnectionError):
+        FHIR(server.endpoint, ignore_errors=False, backoff=0.01).get_patients_observations(['failing'])
+    assert server.paths().count('/api/Observation/failing') == 4
+
+
+def test_lazy(server, patient_pages, observation_pages, observation_bundles):
+    fhir = FHIR(server.endpoint, lazy=True)
+    patients = fhir.get_all_patients()
+    assert all(isinstance(patient, LazyPatient) for patient in patients)
+    assert [p.uuid for p in patients] == [p.uuid for p in FHIR(server.endpoint).get_all_patients()]
+    observations = list(fhir.iter_patient_observations(observation_pages, prefetch=2, processes=1))
+    assert all(isinstance(observation, LazyObservation) for observation in observations)
+    test_parser.test_observation_parser(observations[78])
+
+    corrupt = copy.deepcopy(observation_bundles)
+    del corrupt[0]['entry'][0]['resource']['subject']
+    server.add_json('/api/Observation/corrupt', corrupt)
+    assert len(fhir.get_patient_observations('corrupt')) == 82
+    assert len(FHIR(server.endpoint, lazy=True, ignore_errors=False).get_patient_observations('corrupt')) == 83
+
+
+def since_route(bundles):
+    """A route serving only the entries updated at or after the _since query parameter"""
+    def route(handler, body):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query)
+        since = parse_datetime(query['_since'][0]) if '_since' in query else None
+        filtered = copy.deepcopy(bundles)
+        for bundle in filtered:
+            bundle['entry'] = [e for e in bundle['entry']
+                               if since is None or parse_datetime(e['resource']['meta']['lastUpdated']) >= since]
+        return 200, json.dumps(filtered), {}
+    return route
+
+
+def test_sync(server, patient_bundles, observation_bundles):
+    patients = copy.deepcopy(patient_bundles)
+    observations = copy.deepcopy(observation_bundles)
+    server.routes['/api/Patient/'] = since_route(patients)
+    server.routes['/api/Observation/patient-1'] = since_route(observations)
+    store = Store()
+    fhir = FHIR(server.endpoint)
+
+    mark = fhir.sync_patients(store)
+    assert len(store.patients) == 10
+    assert mark == max((e['resource']['meta']['lastUpdated'] for e in patients[0]['entry']), key=parse_datetime)
+    observation_mark = fhir.sync_patient_observations('patient-1', store)
+    assert len(store.observations) == 83
+
+    updated = patients[0]['entry'][0]['resource']
+    updated['name'][0]['family'] = 'Updated'
+    updated['meta']['lastUpdated'] = '2020-03-01T10:00:00.000+00:00'
+    assert fhir.sync_patients(store, mark) == '2020-03-01T10:00:00.000+00:00'
+    assert server.requests[-1][1] == '/api/Patient/?_since=' + urllib.parse.quote(mark)
+    assert len(store.patients) == 10
+    assert store.patient(updated['id']).name.family == 'Updated'
+    assert fhir.sync_patients(store, '2020-03-01T10:00:00.000+00:00') == '2020-03-01T10:00:00.000+00:00'
+    assert fhir.sync_patients(store, datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)) == \
+        '2021-01-01T00:00:00+00:00'
+
+    assert fhir.sync_patient_observations('patient-1', store, observation_mark) == observation_mark
+    assert len(store.observations) == 83
+
+
+def test_search(server, patient_pages, observation_bundles):
+    def route(handler, body):
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query)
+        filtered = copy.deepcopy(observation_bundles)
+        for bundle in filtered:
+            bundle['entry'] = [e for e in bundle['entry'] if e['resource']['code']['coding'][0]['code'] in query['code']]
+            if '_elements' in query:
+                for entry in bundle['entry']:
+                    entry['resource'] = project(entry['resource'], query['_elements'][0].split(','))
+        return 200, json.dumps(filtered), {}
+
+    server.routes['/api/Observation/patient-1'] = route
+    fhir = FHIR(server.endpoint)
+    expected = fhir.get_patient_observations('patient-1', search={'code': '8302-2'})
+    search = {'code': '8302-2', 'date': ['ge2011-01-01', 'lt2012-01-01'], '_elements': 'code,valueQuantity'}
+    observations = fhir.get_patient_observations('patient-1', search=search)
+    assert len(observations) == len(expected) > 0
+    assert [(c.code, c.value, c.unit) for o in observations for c in o.components] == \
+        [(c.code, c.value, c.unit) for o in expected for c in o.components]
+    assert [o.uuid for o in fhir.stream_patient_observations('patient-1', search=search)] == [o.uuid for o in expected]
+    assert 'category' not in observations[0].resource
+    assert server.paths()[-1] == '/api/Observation/patient-1?code=8302-2&date=ge2011-01-01&date=lt2012-01-01' \
+                                 '&_elements=code%2CvalueQuantity'
+
+    assert len(list(fhir.iter_patients(search={'_count': 5}))) == 10
+    assert server.paths()[-2:] == ['/api/Patient/pages/1?_count=5', '/api/Patient/pages/2?_count=5']
+    observations = fhir.get_patients_observations(['patient-1'], search={'code': '9279-1'})['patient-1']
+    assert [o.uuid for o in observations] == \
+        [o.uuid for o in fhir.get_patient_observations('patient-1', search={'code': ['9279-1']})]
+    assert len(observations) == 8
+
+
+def test_bulk_export(server, patient_bundles, observation_bundles):
+    files = {'patients': [e['resource'] for e in patient_bundles[0]['entry']],
+             'observations': [e['resource'] for b in observation_bundles for e in b['entry']],
+             'encounters': [{'resourceType': 'Encounter', 'id': 'e'}]}
+    for name, resources in files.items():
+        server.routes['/files/{}.ndjson'.format(name)] = \
+            (200, '\n'.join(json.dumps(r) for r in resources) + '\n', {'Content-Type': 'application/fhir+ndjson'})
+    polls = []
+
+    def status(handler, body):
+        polls.append(time.monotonic())
+        if len(polls) == 1:
+            return 202, '', {'Retry-After': '0', 'X-Progress': 'Exporting'}
+        return 200, json.dumps({
+            'transactionTime': '2020-03-01T10:00:00.000+00:00', 'requiresAccessToken': False,
+            'output': [{'type': type, 'url': server.endpoint.replace('/api/', '/files/{}.ndjson'.format(name))}
+                       for type, name in [('Patient', 'patients'), ('Observation', 'observations'),
+                                          ('Encounter', 'encounters')]],
+            'error': []}), {}
+
+    server.routes['/api/Patient/$export'] = (202, '', {'Content-Location': server.endpoint + 'export/1'})
+    server.routes['/api/export/1'] = status
+    fhir = FHIR(server.endpoint)
+
+    resources = list(fhir.bulk_export(since='2020-01-01T00:00:00+00:00'))
+    assert [r.uuid for r in resources] == [r['id'] for r in files['patients'] + files['observations']]
+    assert len(polls) == 2
+    kick_off = server.requests[0]
+    assert kick_off[1] == '/api/Patient/$export?_type=Patient%2CObservation&_since=2020-01-01T00%3A00%3A00%2B00%3A00'
+    assert kick_off[2]['Prefer'] == 'respond-async'
+
+    polls.clear()
+    manifest = FHIR(server.endpoint, lazy=True).export_manifest(poll_interval=0)
+    assert manifest['transactionTime'] == '2020-03-01T10:00:00.000+00:00'
+    assert all(isinstance(r, (LazyPatient, LazyObservation))
+               for r in FHIR(server.endpoint, lazy=True).iter_export(manifest))
+
+    polls.clear()
+    server.routes['/api/export/1'] = (202, '', {'Retry-After': '1'})
+    with pytest.raises(TimeoutError):
+        fhir.export_manifest(timeout=0.5)
+    server.routes['/api/Patient/$export'] = (200, load('test_error.json'), {})
+    with pytest.raises(ConnectionError):
+        fhir.export_manifest()
+    server.routes['/api/Patient/$export'] = (200, '{}', {})
+    with pytest.raises(StatusError) as error:
+        fhir.export_manifest()
+    assert error.value.status == 200
+    with pytest.raises(StatusError) as error:
+        list(fhir.iter_export({'output': [{'type': 'Patient', 'url': server.endpoint + 'missing.ndjson'}]}))
+    assert error.value.status == 404
+
+
+def test_batch(server, patient_bundles, observation_bundles):
+    resources = {'Patient/' + e['resource']['id']: e['resource'] for e in patient_bundles[0]['entry']}
+    resources.update({'Observation/single/' + e['resource']['id']: e['resource']
+                      for b in observation_bundles for e in b['entry']})
+    resources['Patient/corrupt'] = {'resourceType': 'Patient', 'id': 'corrupt'}
+    resources['Patient/malformed'] = dict(patient_bundles[0]['entry'][0]['resource'], id='malformed',
+                                          birthDate='not a date')
+    error = json.loads(load('test_error.json'))
+
+    def batch(handler, body):
+        request = json.loads(body)
+        assert request['type'] == 'batch' and handler.headers['Content-Type'] == 'application/fhir+json'
+        entries = [{'resource': resources[e['request']['url']], 'response': {'status': '200 OK'}}
+                   if e['request']['url'] in resources else {'response': {'status': '404 Not Found', 'outcome': error}}
+                   for e in request['entry']]
+        return 200, json.dumps({'resourceType': 'Bundle', 'type': 'batch-response', 'entry': entries}), {}
+
+    server.routes['/api/'] = batch
+    fhir = FHIR(server.endpoint)
+    ids = [e['resource']['id'] for e in patient_bundles[0]['entry']]
+    patients = fhir.get_patients(ids[::-1] + ['missing', 'corrupt', 'malformed'] + ids[:2], chunk_size=4)
+    assert list(patients.keys()) == ids[::-1]
+    assert all(patients[id].uuid == id for id in ids)
+    assert [r[0] for r in server.requests] == ['POST'] * 4
+
+    observation_ids = [e['resource']['id'] for b in observation_bundles for e in b['entry']]
+    observations = fhir.get_observations(observation_ids)
+    assert [o.uuid for o in observations.values()] == observation_ids
+    test_parser.test_observation_parser(observations['4a064229-2a40-45f4-a259-f4eedcfd525a'])
+    assert len(server.requests) == 5
+
+    with pytest.raises(ConnectionError):
+        FHIR(server.endpoint, ignore_errors=False).get_patients(ids[:1] + ['missing'])
+    with pytest.raises(AttributeError):
+        FHIR(server.endpoint, ignore_errors=False).get_patients(['corrupt'])
+    with pytest.raises(ValueError):
+        FHIR(server.endpoint, ignore_errors=False).get_patients(['malformed'])
+
+
+def test_joined(server, patient_bundles, observation_bundles):
+    uuid = '8f789d0b-3145-4cf2-8504-13159edaa747'
+    observation_entries = [dict(e, search={'mode': 'include'}) for b in observation_bundles for e in b['entry']]
+    pages = split_pages(patient_bundles[0], 5)
+    for number, page in enumerate(pages, 1):
+        if any(e['resource']['id'] == uuid for e in page['entry']):
+            page['entry'] = page['entry'] + observation_entries
+        server.add_json('/api/Patient/pages/{}?_count=5&_revinclude=Observation%3Asubject'.format(number), [page])
+    everything = copy.deepcopy(patient_bundles[0])
+    everything['entry'] = [e for e in everything['entry'] if e['resource']['id'] == uuid] + observation_entries
+    server.add_json('/api/Patient/{}/$everything'.format(uuid), everything)
+    fhir = FHIR(server.endpoint)
+
+    joined = fhir.get_patients_with_observations(prefetch=2, search={'_count': 5})
+    assert list(joined.keys()) == [e['resource']['id'] for e in patient_bundles[0]['entry']]
+    assert len(joined[uuid][1]) == 83
+    assert sum(len(observations) for patient, observations in joined.values()) == 83
+    assert [p.uuid for p, o in fhir.iter_patients_with_observations(search={'_count': 5})] == list(joined.keys())
+
+    patient, observations = fhir.get_patient_everything(uuid)
+    assert patient.uuid == uuid
+    assert [o.uuid for o in observations] == [o.uuid for o in joined[uuid][1]]
+    with pytest.raises(ConnectionError):
+        fhir.get_patient_everything('missing')
@@ -0,0 +1,111 @@
+import copy
+import datetime
+from collections import Counter
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from fhir_parser.frame import ObservationFrame, PatientFrame
+
+
+@pytest.fixture(scope='module')
+def frame(observations):
+    return ObservationFrame.from_observations(observations)
+
+
+def test_observation_frame(frame, observations, observation_bundles):
+    components = [(o, c) for o in observations for c in o.components]
+    assert len(frame) == len(components)
+    assert frame.code.values().tolist() == [c.code for o, c in components]
+    assert frame.patient_uuid.values()[0] == '8f789d0b-3145-4cf2-8504-13159edaa747'
+    assert frame.effective.dtype == np.dtype('datetime64[us]')
+
+    bundled = ObservationFrame.from_bundles(observation_bundles)
+    assert bundled.code.values().tolist() == frame.code.values().tolist()
+    assert np.array_equal(bundled.value, frame.value, equal_nan=True)
+
+
+def test_value_counts(frame, observations):
+    expected = Counter(c.code for o in observations for c in o.components)
+    counts = frame.value_counts('code')
+    assert counts == dict(expected)
+    assert list(counts.values()) == sorted(counts.values(), reverse=True)
+    assert frame.value_counts('type') == dict(Counter(o.type for o in observations for c in o.components))
+
+
+def test_groupby(frame, observations):
+    values = {}
+    for o in observations:
+        for c in o.components:
+            if c.value is not None:
+                values.setdefault(c.code, []).append(c.value)
+    means = frame.groupby('code').mean()
+    for code, code_values in values.items():
+        assert means[code] == pytest.approx(sum(code_values) / len(code_values))
+    assert np.isnan(means['85354-9'])
+    assert frame.groupby('code').count()['8462-4'] == len(values['8462-4'])
+    assert sum(frame.groupby('code').size().values()) == len(frame)
+
+
+def test_observation_frame_errors(observation_bundles):
+    bundles = copy.deepcopy(observation_bundles)
+    del bundles[0]['entry'][0]['resource']['effectiveDateTime']
+    frame = ObservationFrame.from_bundles(bundles, ignore_errors=True)
+    assert len(set(frame.uuid.values().tolist())) == 82
+    with pytest.raises(KeyError):
+        ObservationFrame.from_bundles(bundles)
+
+
+def test_between(frame, observations):
+    start = datetime.datetime(2011, 9, 20, tzinfo=datetime.timezone.utc)
+    end = datetime.datetime(2012, 1, 1, tzinfo=datetime.timezone.utc)
+    expected = [c.code for o in observations for c in o.components if start <= o.effective_datetime < end]
+    subset = frame.between(start, end)
+    assert len(expected) > 0
+    assert subset.code.values().tolist() == expected
+    assert len(frame.between(start)) + len(frame.between(end=start)) == len(frame)
+    assert len(frame[frame.code.isin(['8462-4'])]) == frame.value_counts()['8462-4']
+    others = frame[~frame.code.isin(['8462-4', '8480-6'])]
+    assert len(others) == len(frame) - frame.value_counts()['8462-4'] - frame.value_counts()['8480-6']
+    assert '8462-4' not in others.value_counts()
+    assert len(frame[frame.code.isin([])]) == 0
+    assert frame.code in {frame.code}
+
+
+def test_patient_frame(patients, patient_bundles):
+    frame = PatientFrame.from_patients(patients)
+    assert len(frame) == 10
+    assert frame.uuid.tolist() == [p.uuid for p in patients]
+    assert frame.birth_date.dtype == np.dtype('datetime64[D]')
+
+    reference = datetime.date(2020, 3, 1)
+    assert frame.ages(reference).tolist() == pytest.approx([(reference - p.birth_date).days / 365.25 for p in patients])
+    assert frame.ages() == pytest.approx([p.age() for p in patients])
+
+    assert frame.histogram('gender') == dict(Counter(p.gender for p in patients).most_common())
+    assert frame.histogram('marital_status') == dict(Counter(p.marital_status.marital_status for p in patients))
+    assert frame.histogram('languages') == dict(Counter(l for p in patients for l in p.communications.languages))
+    assert frame.languages.values()[frame.language_offsets[0]:frame.language_offsets[1]].tolist() == ['English']
+    assert frame.latitude[0] == patients[0].addresses[0].latitude
+    assert frame.longitude[0] == patients[0].addresses[0].longitude
+
+    ages = frame.groupby('gender', frame.ages(reference)).mean()
+    for gender in ages:
+        expected = [(reference - p.birth_date).days / 365.25 for p in patients if p.gender == gender]
+        assert ages[gender] == pytest.approx(sum(expected) / len(expected))
+
+    bundled = PatientFrame.from_bundles(patient_bundles)
+    assert bundled.uuid.tolist() == frame.uuid.tolist()
+    assert np.array_equal(bundled.birth_date, frame.birth_date)
+
+
+def test_patient_frame_errors(patient_bundles):
+    bundles = copy.deepcopy(patient_bundles)
+    missing = bundles[0]['entry'][3]['resource']
+    del missing['birthDate']
+    frame = PatientFrame.from_bundles(bundles, ignore_errors=True)
+    assert len(frame) == 9
+    assert missing['id'] not in frame.uuid.tolist()
+    with pytest.raises(KeyError):
+        PatientFrame.from_bundles(bundles)
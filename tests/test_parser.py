@@ -1,12 +1,17 @@
 import datetime
+import json
 from typing import List
 import os
 
+import dateutil.parser
 import pytest
 
 from fhir_parser import Patient, Observation
+from fhir_parser import parser
 from fhir_parser.observation import ObservationComponent
-from fhir_parser.parser import str_to_patient, str_to_error, str_to_patients, str_to_observation, str_to_observations
+from fhir_parser.parser import str_to_patient, str_to_error, str_to_patients, str_to_observation, str_to_observations, \
+    dict_to_patient, dict_to_observation, iter_stream_resources, iter_stream_patients, iter_stream_observations, \
+    dict_to_error, parse_date, parse_datetime, LazyPatient, LazyObservation
 from fhir_parser.patient import Extension, Identifier
 
 
@@ -129,4 +134,159 @@ def test_observation_parser(observation):
 
 def test_observations_parser(observations):
     assert len(observations) == 83
-    test_observation_parser(observations[78])
\ No newline at end of file
+    test_observation_parser(observations[78])
+
+
+def test_dict_parsers():
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_patient.json'), 'r') as patient_file:
+        test_patient_parser(dict_to_patient(json.load(patient_file)))
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_observation.json'), 'r') as observation_file:
+        test_observation_parser(dict_to_observation(json.load(observation_file)))
+
+
+def chunks(name: str, size: int):
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), name), 'rb') as file:
+        data = file.read()
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 7, 4096, 10 ** 7])
+def test_stream_parser(size):
+    patients = list(iter_stream_patients(chunks('test_patients.json', size)))
+    assert len(patients) == 10
+    test_patient_parser(patients[0])
+
+    observations = list(iter_stream_observations(chunks('test_observations.json', size)))
+    assert len(observations) == 83
+    test_observation_parser(observations[78])
+
+
+def test_stream_parser_resources():
+    bundle = json.dumps({'resourceType': 'Bundle', 'total': 2, 'entry': [{'resource': {'id': 'a'}}, {},
+                                                                           {'fullUrl': 'b', 'resource': {'id': 'b'}}]})
+    assert list(iter_stream_resources([bundle.encode('utf-8')])) == [{'id': 'a'}, {'id': 'b'}]
+    assert list(iter_stream_resources([b'[]'])) == []
+    assert list(iter_stream_resources([b'[{"resourceType": "Bundle", "entry": []}]'])) == []
+
+    test_patient_parser(list(iter_stream_patients(chunks('test_patient.json', 3)))[0])
+    assert dict_to_error(list(iter_stream_resources(chunks('test_error.json', 5)))[0]) == \
+        'Resource type \'Patient\' with id \'8f789d0b-3145-4cf2-8504-13159edaa757\' couldn\'t be found.'
+
+    with pytest.raises(ValueError):
+        list(iter_stream_resources([b'[{"resourceType": "Bundle", "entry": [{"resource": {"id": 1']))
+
+
+@pytest.mark.parametrize('value', ['2011-09-20T21:27:12+01:00', '2011-09-20T21:27:12.215+01:00', '2011-09-20T21:27:12Z',
+                                   '2011-09-20T21:27:12.2154-05:00', '2011-09-20', '2011-09', '2011'])
+def test_parse_datetime(value):
+    assert parse_datetime(value) == dateutil.parser.isoparse(value)
+    assert parse_datetime(value).utcoffset() == dateutil.parser.isoparse(value).utcoffset()
+
+
+@pytest.mark.parametrize('value', ['1998-08-25', '1998-08', '1998'])
+def test_parse_date(value):
+    assert parse_date(value) == dateutil.parser.isoparse(value).date()
+
+
+def test_lazy_parser():
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_patient.json'), 'r') as patient_file:
+        patient = str_to_patient(patient_file.read(), lazy=True)
+    assert isinstance(patient, LazyPatient)
+    assert patient.birth_date == datetime.date(year=1998, month=8, day=25)
+    assert 'birth_date' in patient.__dict__ and 'name' not in patient.__dict__
+    test_patient_parser(patient)
+    patient.gender = 'male'
+    assert patient.gender == 'male'
+
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_observation.json'), 'r') as observation_file:
+        observation = str_to_observation(observation_file.read(), lazy=True)
+    assert isinstance(observation, LazyObservation)
+    assert observation.type == 'vital-signs'
+    assert 'components' not in observation.__dict__
+    test_observation_parser(observation)
+
+    with pytest.raises(AssertionError):
+        dict_to_patient({'resourceType': 'Observation'}, lazy=True)
+
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_observations.json'), 'r') as observations_file:
+        observations = str_to_observations(observations_file.read(), lazy=True)
+    assert len(observations) == 83
+    test_observation_parser(observations[78])
+
+
+def test_lazy_parser_errors(observation_bundles, patient_bundles):
+    bundles = json.loads(json.dumps(observation_bundles))
+    del bundles[0]['entry'][0]['resource']['effectiveDateTime']
+    # Skipping errors checks the fields are present up front, as eager parsing would fail on them
+    assert len(str_to_observations(json.dumps(bundles), ignore_errors=True, lazy=True)) == 82
+    observations = str_to_observations(json.dumps(bundles), lazy=True)
+    assert len(observations) == 83
+    with pytest.raises(KeyError):
+        observations[0].effective_datetime
+
+    patients = json.loads(json.dumps(patient_bundles))
+    del patients[0]['entry'][3]['resource']['birthDate']
+    assert len(list(iter_stream_patients([json.dumps(patients).encode()], ignore_errors=True, lazy=True))) == 9
+    # Resources projected by an _elements search are tagged and only hold the requested fields
+    resource = {'resourceType': 'Patient', 'id': 'a', 'gender': 'female', 'meta': {'tag': [{'code': 'SUBSETTED'}]}}
+    assert dict_to_patient(resource, lazy=True, check=True).gender == 'female'
+    with pytest.raises(KeyError):
+        dict_to_patient(dict(resource, meta={}), lazy=True, check=True)
+
+
+def test_slots(patient, observation):
+    for model in [patient, patient.name, patient.telecoms[0], patient.addresses[0], patient.marital_status,
+                  patient.communications, patient.extensions[0], patient.identifiers[0], observation,
+                  observation.components[0]]:
+        assert not hasattr(model, '__dict__')
+
+    assert ObservationComponent('http://loinc.org', '8462-4', 'Diastolic Blood Pressure', 76.0, 'mm[Hg]') == \
+        ObservationComponent('http://loinc.org', '8462-4', 'Diastolic Blood Pressure', 76.0, 'mm[Hg]')
+    assert ObservationComponent('http://loinc.org', '8462-4', 'Diastolic Blood Pressure', 76.0, 'mm[Hg]') != \
+        ObservationComponent('http://loinc.org', '8462-4', 'Diastolic Blood Pressure', 77.0, 'mm[Hg]')
+    assert Extension('us-core-birthsex', 'F') != Identifier('', '', '', '')
+
+
+def test_intern_pool(patients, observations):
+    statuses = {}
+    for p in patients:
+        assert statuses.setdefault(p.marital_status.marital_status, p.marital_status) is p.marital_status
+    assert len(statuses) < len(patients)
+    components = [c for o in observations for c in o.components if c.system == 'http://loinc.org']
+    assert all(c.system is components[0].system for c in components)
+    assert all(o.type is observations[0].type for o in observations if o.type == observations[0].type)
+    assert patients[0].communications.communication[0] is patients[1].communications.communication[0]
+
+    try:
+        parser.clear_intern_pool()
+        parser.INTERN_POOL_SIZE = 1
+        assert parser.intern_value(''.join(['a', 'b'])) is parser.intern_value(''.join(['a', 'b']))
+        value = ''.join(['c', 'd'])
+        assert parser.intern_value(value) is value
+        assert len(parser._intern_pool) == 1
+    finally:
+        parser.INTERN_POOL_SIZE = 65536
+        parser.clear_intern_pool()
+
+
+@pytest.mark.parametrize('backend', ['orjson', 'ujson', 'json'])
+def test_json_backend(backend):
+    pytest.importorskip(backend)
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_observations.json'), 'rb') as file:
+        content = file.read()
+    selected = parser.JSON_BACKEND
+    try:
+        assert parser.set_json_backend(backend) == backend
+        from_bytes = str_to_observations(content)
+        from_text = str_to_observations(content.decode('utf-8'))
+        assert [str(o) for o in from_bytes] == [str(o) for o in from_text]
+        assert len(from_bytes) == 83
+        assert str_to_error(content) is None
+    finally:
+        parser.set_json_backend(selected)
+
+
+def test_json_backend_selection():
+    assert parser.JSON_BACKEND in ['orjson', 'ujson', 'json']
+    with pytest.raises(ValueError):
+        parser.set_json_backend('simplejson')
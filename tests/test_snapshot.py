@@ -0,0 +1,71 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('pyarrow')
+np = pytest.importorskip('numpy')
+
+from fhir_parser import snapshot
+from fhir_parser.frame import ObservationFrame, PatientFrame
+from fhir_parser.observation import Observation
+from fhir_parser.snapshot import Snapshot, write_snapshot
+
+
+@pytest.fixture
+def opened(tmp_path, patients, observations, monkeypatch):
+    # Small batches so the tables are read back from several record batches
+    monkeypatch.setattr(snapshot, 'BATCH_SIZE', 7)
+    write_snapshot(str(tmp_path / 'snapshot'), patients, observations)
+    return Snapshot(str(tmp_path / 'snapshot'))
+
+
+def _patient_fields(patient):
+    return (patient.uuid, patient.name.full_name, patient.name.prefix_list, [str(t) for t in patient.telecoms],
+            patient.gender, patient.birth_date, [(str(a), a.latitude, a.longitude, a.extensions)
+                                                 for a in patient.addresses],
+            patient.marital_status.marital_status, patient.multiple_birth, patient.communications.communication,
+            patient.extensions, patient.identifiers)
+
+
+def _observation_fields(observation):
+    return (observation.uuid, observation.type, observation.status, observation.patient_uuid,
+            observation.encounter_uuid, observation.effective_datetime, observation.effective_datetime.utcoffset(),
+            observation.issued_datetime, observation.components)
+
+
+def test_round_trip(opened, patients, observations):
+    assert [_patient_fields(p) for p in opened.patients()] == [_patient_fields(p) for p in patients]
+    assert [_observation_fields(o) for o in opened.observations()] == [_observation_fields(o) for o in observations]
+
+
+def test_observation_without_components(tmp_path):
+    effective = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    issued = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone(datetime.timedelta(hours=-5)))
+    write_snapshot(str(tmp_path), observations=[Observation('a', 'vital-signs', 'final', 'p', 'e', effective, issued,
+                                                            [])])
+    restored = list(Snapshot(str(tmp_path)).observations())
+    assert len(restored) == 1
+    assert restored[0].components == []
+    assert restored[0].effective_datetime == effective and restored[0].effective_datetime.tzinfo is None
+    assert restored[0].issued_datetime == issued and restored[0].issued_datetime.utcoffset() == issued.utcoffset()
+    assert len(Snapshot(str(tmp_path)).observation_frame()) == 0
+    assert list(Snapshot(str(tmp_path)).patients()) == []
+
+
+def test_frames(opened, patients, observations):
+    frame = opened.observation_frame()
+    expected = ObservationFrame.from_observations(observations)
+    for name in ObservationFrame.CATEGORICAL:
+        assert getattr(frame, name).values().tolist() == getattr(expected, name).values().tolist()
+    assert np.array_equal(frame.value, expected.value, equal_nan=True)
+    assert np.array_equal(frame.effective, expected.effective)
+    assert frame.value_counts() == expected.value_counts()
+
+    patient_frame = opened.patient_frame()
+    expected = PatientFrame.from_patients(patients)
+    assert patient_frame.uuid.tolist() == expected.uuid.tolist()
+    assert np.array_equal(patient_frame.birth_date, expected.birth_date)
+    assert patient_frame.histogram('gender') == expected.histogram('gender')
+    assert patient_frame.histogram('languages') == expected.histogram('languages')
+    assert np.array_equal(patient_frame.language_offsets, expected.language_offsets)
+    assert np.array_equal(patient_frame.latitude, expected.latitude, equal_nan=True)
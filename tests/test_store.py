@@ -0,0 +1,69 @@
+import copy
+import datetime
+
+import pytest
+
+from fhir_parser.store import Store
+
+
+@pytest.fixture
+def store(patients, observations):
+    store = Store()
+    store.add_patients(patients)
+    store.add_observations(observations)
+    return store
+
+
+def test_patient_lookups(store):
+    patient = store.patient('8f789d0b-3145-4cf2-8504-13159edaa747')
+    assert patient.name.full_name == 'Ms. Abby752 Beatty507'
+    assert store.find_patient('999-58-8677', 'SS') is patient
+    assert store.find_patient('999-58-8677') is patient
+    assert store.find_patient('999-58-8677', 'DL') is None
+    assert store.find_patient('S99995899', 'DL') is patient
+    assert store.patient('missing') is None
+
+    store.remove_patient(patient.uuid)
+    assert store.find_patient('999-58-8677') is None
+    assert len(store.patients) == 9
+
+
+def test_observation_lookups(store):
+    observations = list(store.observations.values())
+    assert len(store.patient_observations('8f789d0b-3145-4cf2-8504-13159edaa747')) == 83
+    assert store.encounter_observations('04090f8c-076e-4af1-9582-98d8cae66764') == \
+        [o for o in observations if o.encounter_uuid == '04090f8c-076e-4af1-9582-98d8cae66764']
+    assert store.code_observations('8462-4') == \
+        [o for o in observations if any(c.code == '8462-4' for c in o.components)]
+    assert len(store.joined()['8f789d0b-3145-4cf2-8504-13159edaa747'][1]) == 83
+
+
+def test_observations_between(store):
+    observations = list(store.observations.values())
+    start = datetime.datetime(2011, 9, 20, tzinfo=datetime.timezone.utc)
+    end = datetime.datetime(2014, 1, 1, tzinfo=datetime.timezone.utc)
+    expected = sorted([o for o in observations if start <= o.effective_datetime < end],
+                      key=lambda o: (o.effective_datetime, o.uuid))
+    assert len(expected) > 0
+    assert store.observations_between(start, end) == expected
+    assert len(store.observations_between()) == 83
+
+    replaced = copy.copy(expected[0])
+    replaced.effective_datetime = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    store.add_observation(replaced)
+    assert len(store.observations) == 83
+    assert store.observations_between(end=start)[0] is replaced
+    assert replaced not in store.observations_between(start, end)
+
+
+def test_effective_index(store, observations):
+    index = store._effective
+    removed = store.remove_observation(observations[5].uuid)
+    moved = copy.copy(observations[10])
+    moved.effective_datetime = datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc)
+    store.add_observations([moved, removed, moved])
+    # Kept up to date in place rather than rebuilt
+    assert store._effective is index
+    assert len(index) == len(store.observations) == 83
+    assert index == sorted((o.effective_datetime.timestamp(), o.uuid) for o in store.observations.values())
+    assert store.observations_between(datetime.datetime(2029, 1, 1, tzinfo=datetime.timezone.utc)) == [moved]
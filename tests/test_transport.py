@@ -0,0 +1,96 @@
+import email.utils
+import socket
+import time
+
+import pytest
+import requests
+
+from conftest import load
+from fhir_parser import FHIR
+from fhir_parser.transport import RateLimiter, backoff_delay, retry_after
+
+
+def flaky(responses):
+    """A route answering with each of responses in turn, then the last one for every later request"""
+    calls = []
+
+    def route(handler, body):
+        calls.append(time.monotonic())
+        return responses[min(len(calls), len(responses)) - 1]
+    route.calls = calls
+    return route
+
+
+def test_retry_statuses(server):
+    patient = (200, load('test_patient.json'), {})
+    server.routes['/api/Patient/a'] = flaky([(503, '', {'Retry-After': '0'}), (500, '', {}), (502, '', {}), patient])
+    server.routes['/api/Patient/b'] = flaky([(500, '', {})])
+    server.routes['/api/Patient/c'] = flaky([(404, '', {})])
+    fhir = FHIR(server.endpoint, retries=3, backoff=0.01)
+
+    assert fhir.get_patient('a').uuid == '8f789d0b-3145-4cf2-8504-13159edaa747'
+    assert len(server.routes['/api/Patient/a'].calls) == 4
+    with pytest.raises(ConnectionError):
+        fhir.get_patient('b')
+    assert len(server.routes['/api/Patient/b'].calls) == 4
+    with pytest.raises(ConnectionError):
+        fhir.get_patient('c')
+    assert len(server.routes['/api/Patient/c'].calls) == 1
+
+
+def test_retry_after(server):
+    date = email.utils.formatdate(time.time() + 2, usegmt=True)
+    route = flaky([(429, '', {'Retry-After': '0.3'}), (429, '', {'Retry-After': date}),
+                   (200, load('test_patient.json'), {})])
+    server.routes['/api/Patient/a'] = route
+    FHIR(server.endpoint, backoff=0).get_patient('a')
+    assert route.calls[1] - route.calls[0] >= 0.3
+    # The HTTP date only has second precision
+    assert route.calls[2] - route.calls[1] > 0.5
+
+
+def test_timeouts(server):
+    def slow(handler, body):
+        calls.append(handler.path)
+        time.sleep(0.3 if len(calls) == 1 else 0)
+        return 200, load('test_patient.json'), {}
+    calls = []
+    server.routes['/api/Patient/a'] = slow
+
+    with pytest.raises(requests.exceptions.Timeout):
+        FHIR(server.endpoint, timeout=(1, 0.1), retries=0).get_patient('a')
+    calls.clear()
+    assert FHIR(server.endpoint, timeout=(1, 0.1), retries=1, backoff=0.01).get_patient('a') is not None
+    assert len(calls) == 2
+
+
+def test_connection_errors(monkeypatch):
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        endpoint = 'http://127.0.0.1:{}/api/'.format(unused.getsockname()[1])
+    delays = []
+    monkeypatch.setattr(time, 'sleep', delays.append)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        FHIR(endpoint, retries=4, backoff=1, max_backoff=4).get_patient('a')
+    assert len(delays) == 4
+    assert all(0 <= delay <= ceiling for delay, ceiling in zip(delays, [1, 2, 4, 4]))
+
+
+def test_backoff_delay():
+    assert all(0 <= backoff_delay(attempt, 0.5, 10) <= min(10, 0.5 * 2 ** attempt) for attempt in range(10))
+
+
+def test_rate_limit(server):
+    server.routes['/api/Patient/a'] = (200, load('test_patient.json'), {})
+    fhir = FHIR(server.endpoint, rate_limit=20)
+    start = time.monotonic()
+    for _ in range(6):
+        fhir.get_patient('a')
+    assert time.monotonic() - start >= 0.25
+
+    limiter = RateLimiter(1000)
+    limiter.pause(0.2)
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.15
+    assert retry_after(requests.Response()) is None